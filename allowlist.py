@@ -1,39 +1,121 @@
 from pathlib import Path
+import re
+
+from file_utils import atomic_write
+
+# Telegram IDs; groups and channels are negative.
+VALID_ID = re.compile(r"^-?\d+$")
+# Journal prefix marking a removal, chosen so it can't be mistaken for an ID.
+REMOVED = "del:"
 
 
 class AllowList:
+    """
+    Allowed user IDs.  Kept in a dict (used as an ordered set) so membership checks are
+    O(1) and /listusers still shows the IDs in the order they were added.
+
+    The file is a journal: one ID per line to add it, `del:ID` to remove it.  save() only
+    appends what changed since the last save, and rewrites the file compactly once the
+    removed entries start to outweigh the live ones.
+    """
+
     def __init__(self, filename: str) -> None:
         self.filename = filename
-        self.id_list = []
+        self.ids = {}
+        self.pending = []  # journal lines not written yet
+        self.file_lines = 0  # journal lines currently in the file
         if not self.file_exists(self.filename):
             with open(self.filename, mode="w") as f:
                 pass
         else:
             self.load()
 
+    @property
+    def id_list(self) -> list[str]:
+        return list(self.ids)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
     def file_exists(self, filename: str) -> bool:
         return Path(filename).exists()
 
+    @staticmethod
+    def valid_id(id: str) -> bool:
+        return bool(VALID_ID.match(id))
+
     def add_user(self, id: str) -> None:
-        if id not in self.id_list:
-            self.id_list.append(id)
+        if id not in self.ids:
+            self.ids[id] = None
+            self.pending.append(id)
 
     def remove_user(self, id: str) -> None:
-        if id in self.id_list:
-            self.id_list.pop(self.id_list.index(id))
+        if id in self.ids:
+            del self.ids[id]
+            self.pending.append(REMOVED + id)
 
     def user_exists(self, id: str) -> bool:
-        return True if id in self.id_list else False
+        return id in self.ids
 
     def save(self) -> None:
-        with open(self.filename, mode="w") as f:
-            for id in self.id_list:
-                f.write(id + "\n")
+        if not self.pending:
+            return
+        if self.file_lines + len(self.pending) > 2 * len(self.ids) + 16:
+            self.compact()
+            return
+        with open(self.filename, mode="a") as f:
+            f.write("".join(line + "\n" for line in self.pending))
+        self.file_lines += len(self.pending)
+        self.pending.clear()
+
+    def compact(self) -> None:
+        """Rewrites the file with only the live IDs."""
+        atomic_write(self.filename, "".join(id + "\n" for id in self.ids))
+        self.file_lines = len(self.ids)
+        self.pending.clear()
+
+    def read_file(self) -> tuple[dict, int, list[str]]:
+        """Streams the journal.  Returns (ids, journal line count, malformed lines)."""
+        ids = {}
+        file_lines = 0
+        bad_lines = []
+        with open(self.filename, mode="r") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                removal = line.startswith(REMOVED)
+                id = line[len(REMOVED):] if removal else line
+                if not self.valid_id(id):
+                    bad_lines.append(line)
+                    continue
+                file_lines += 1
+                if removal:
+                    ids.pop(id, None)
+                else:
+                    ids[id] = None
+        return ids, file_lines, bad_lines
 
     def load(self) -> None:
         if self.file_exists(self.filename):
-            self.id_list.clear()
-            with open(self.filename, mode="r") as f:
-                lines = f.readlines()
-            for line in lines:
-                self.id_list.append(str(line).strip().replace("\n", ""))
+            self.ids, self.file_lines, _ = self.read_file()
+            self.pending.clear()
+
+    def reload(self) -> tuple[list[str], list[str]]:
+        """
+        Re-reads the file after an outside edit.  The new IDs are swapped in at once, and
+        only if every line is valid (ValueError otherwise).  Returns (added, removed).
+        """
+        ids, file_lines, bad_lines = self.read_file()
+        if bad_lines:
+            raise ValueError(f"Invalid lines in {self.filename}: {bad_lines[:3]}")
+        # Our own unsaved changes go on top of the edit; they get written on the next save().
+        for line in self.pending:
+            if line.startswith(REMOVED):
+                ids.pop(line[len(REMOVED):], None)
+            else:
+                ids[line] = None
+        added = [id for id in ids if id not in self.ids]
+        removed = [id for id in self.ids if id not in ids]
+        self.ids, self.file_lines = ids, file_lines
+        return added, removed
@@ -1,6 +1,69 @@
 import logging
 from typing import Union
 
+from file_utils import atomic_write
+
+
+# keys.txt key -> (BotConfiguration attribute, reader method).  A new setting is one line
+# here plus its default in BotConfiguration.__init__.
+SETTINGS = {
+    "openaikey": ("CHAT_GPT_KEY", "read_str"),
+    "botkey": ("BOT_KEY", "read_str"),
+    "admin": ("ADMIN", "read_str"),
+    "googlegemini": ("GEMINI_KEY", "read_str"),
+    "allowlistfilename": ("ALLOW_LIST_FILENAME", "read_str"),
+    "useallowlist": ("USE_ALLOW_LIST", "read_bool"),
+    "chatfile": ("CHAT_FILE", "read_str"),
+    "quotefile": ("QUOTE_FILE", "read_str"),
+    "openaimodel": ("CHAT_GPT_MODEL", "read_str"),
+    "googlegeminimodel": ("GEMINI_MODEL", "read_str"),
+    "openaimaxconcurrent": ("OPENAI_MAX_CONCURRENT", "read_int"),
+    "openairpm": ("OPENAI_RPM", "read_int"),
+    "openaitpm": ("OPENAI_TPM", "read_int"),
+    "geminimaxconcurrent": ("GEMINI_MAX_CONCURRENT", "read_int"),
+    "geminirpm": ("GEMINI_RPM", "read_int"),
+    "geminitpm": ("GEMINI_TPM", "read_int"),
+    "llmqueuetimeout": ("LLM_QUEUE_TIMEOUT", "read_int"),
+    "concurrentupdates": ("CONCURRENT_UPDATES", "read_int"),
+    "modellimits": ("MODEL_LIMITS", "read_model_limits"),
+    "crossfastreply": ("CROSS_FAST_REPLY", "read_bool"),
+    "responsecache": ("RESPONSE_CACHE", "read_bool"),
+    "responsecachesize": ("RESPONSE_CACHE_SIZE", "read_int"),
+    "responsecachettl": ("RESPONSE_CACHE_TTL", "read_int"),
+    "responsecachefile": ("RESPONSE_CACHE_FILE", "read_optional_path"),
+    "userstatedb": ("USER_STATE_DB", "read_path"),
+    "userstateflush": ("USER_STATE_FLUSH", "read_int"),
+    "userstateidle": ("USER_STATE_IDLE_TTL", "read_int"),
+    "userstatemaxloaded": ("USER_STATE_MAX_RESIDENT", "read_int"),
+    "historyturns": ("HISTORY_TURNS", "read_int"),
+    "historytokens": ("HISTORY_TOKENS", "read_int"),
+    "historysummarytokens": ("HISTORY_SUMMARY_TOKENS", "read_int"),
+    "modelhistorytokens": ("MODEL_HISTORY_TOKENS", "read_model_tokens"),
+    "usagefile": ("USAGE_FILE", "read_optional_path"),
+    "usageflush": ("USAGE_FLUSH", "read_int"),
+    "modelprices": ("MODEL_PRICES", "read_model_prices"),
+    "chatpropertiesfile": ("CHAT_PROPERTIES_FILE", "read_path"),
+    "listenmode": ("LISTEN_MODE", "read_choice"),
+    "listenwindow": ("LISTEN_WINDOW", "read_int"),
+    "listenmaxqueue": ("LISTEN_MAX_QUEUE", "read_int"),
+    "transcriptmaxbytes": ("TRANSCRIPT_MAX_BYTES", "read_int"),
+    "transcriptbackups": ("TRANSCRIPT_BACKUPS", "read_int"),
+    "transcriptcompress": ("TRANSCRIPT_COMPRESS", "read_bool"),
+    "logmaxbytes": ("LOG_MAX_BYTES", "read_int"),
+    "logbackups": ("LOG_BACKUPS", "read_int"),
+    "logcompress": ("LOG_COMPRESS", "read_bool"),
+    "logrotate": ("LOG_ROTATE", "read_choice"),
+    "logformat": ("LOG_FORMAT", "read_choice"),
+    "reloadinterval": ("RELOAD_INTERVAL", "read_int"),
+    "metricsinterval": ("METRICS_INTERVAL", "read_int"),
+}
+# Allowed values for the read_choice settings
+CHOICES = {
+    "listenmode": ("window", "mentions"),
+    "logrotate": ("size", "daily"),
+    "logformat": ("text", "json"),
+}
+
 
 # The `BotConfiguration` class is designed to load and verify configuration settings from a
 # file, checking for missing values and logging errors if necessary.
@@ -17,43 +80,196 @@ class BotConfiguration:
         self.QUOTE_FILE = ""
         self.CHAT_GPT_MODEL = ""
         self.GEMINI_MODEL = ""
+        # LLM rate limits (per provider, applied to each model separately)
+        self.OPENAI_MAX_CONCURRENT = 4
+        self.OPENAI_RPM = 60
+        self.OPENAI_TPM = 90000
+        self.GEMINI_MAX_CONCURRENT = 4
+        self.GEMINI_RPM = 60
+        self.GEMINI_TPM = 120000
+        self.LLM_QUEUE_TIMEOUT = 60
+        # Updates handled at the same time, so a slow LLM answer doesn't hold up other chats
+        self.CONCURRENT_UPDATES = 32
+        # model name -> (max concurrent, requests per minute, tokens per minute)
+        self.MODEL_LIMITS = {}
+        # /cross: show the first draft right away and edit in the refined answer
+        self.CROSS_FAST_REPLY = False
+        # Cache of answers to context free prompts
+        self.RESPONSE_CACHE = False
+        self.RESPONSE_CACHE_SIZE = 512
+        self.RESPONSE_CACHE_TTL = 3600
+        self.RESPONSE_CACHE_FILE = "none"  # none = keep it in memory only
+        # Where user states are saved and how often (seconds) changes are written
+        self.USER_STATE_DB = "user_states.db"
+        self.USER_STATE_FLUSH = 30
+        # Users idle this long (seconds) or past the resident limit are dropped from memory
+        self.USER_STATE_IDLE_TTL = 3600
+        self.USER_STATE_MAX_RESIDENT = 5000
+        # Conversation history: exchanges kept per user and chat, and the token budget for them
+        self.HISTORY_TURNS = 10
+        self.HISTORY_TOKENS = 3000
+        self.HISTORY_SUMMARY_TOKENS = 400
+        # model name -> history token budget, for models with bigger or smaller windows
+        self.MODEL_HISTORY_TOKENS = {}
+        # Token/cost accounting file (none = memory only) and how often (seconds) it is written
+        self.USAGE_FILE = "usage.json"
+        self.USAGE_FLUSH = 60
+        # model name -> (USD per million prompt tokens, USD per million completion tokens)
+        self.MODEL_PRICES = {}
+        # Where /listen settings per chat are saved
+        self.CHAT_PROPERTIES_FILE = "chat_properties.json"
+        # /listen batching: "window" answers every LISTEN_WINDOW seconds, "mentions" only
+        # when the bot is mentioned or replied to.  Chats queue at most LISTEN_MAX_QUEUE messages.
+        self.LISTEN_MODE = "window"
+        self.LISTEN_WINDOW = 5
+        self.LISTEN_MAX_QUEUE = 20
+        # CHAT_FILE rotation: size in bytes, old files kept, and whether to gzip them
+        self.TRANSCRIPT_MAX_BYTES = 10 * 1024 * 1024
+        self.TRANSCRIPT_BACKUPS = 5
+        self.TRANSCRIPT_COMPRESS = False
+        # Bot log: rotation ("size" at LOG_MAX_BYTES or "daily"), old files kept, gzip, and
+        # "text" or "json" (one JSON object per line) format
+        self.LOG_MAX_BYTES = 10 * 1024 * 1024
+        self.LOG_BACKUPS = 5
+        self.LOG_COMPRESS = True
+        self.LOG_ROTATE = "size"
+        self.LOG_FORMAT = "text"
+        # Seconds between checks of keys.txt and the allow list for changes
+        self.RELOAD_INTERVAL = 5
+        # Seconds between CPU/memory/disk samples for /cpu and /sys
+        self.METRICS_INTERVAL = 5
+        self.base_logger = logger
         self.logger = logger.getChild("config")
         self.load_config()
         self.verify_config()
+        # What the file said at the last (re)load, so reloads only apply values edited in it.
+        self.file_values = self.settings()
         self.logger.info(f"The configuration '{self.filename}' is loaded.")
 
+    def settings(self) -> dict:
+        return {name: val for name, val in self.__dict__.items() if name.isupper()}
+
+    def reload(self) -> dict:
+        """
+        Re-reads the config file and applies the values that changed in it since the last
+        load.  Values changed at runtime (/model, /toggleallow) are kept unless the file
+        changes them too.  The new file is fully parsed and verified before anything is
+        applied, and nothing is applied if that fails (the exception is raised).
+        Returns {name: (old value, new value)} for what was applied.
+        """
+        fresh = BotConfiguration(self.filename, self.base_logger)
+        new_values = fresh.settings()
+        changes = {}
+        for name, val in new_values.items():
+            if self.file_values.get(name) != val and getattr(self, name) != val:
+                changes[name] = (getattr(self, name), val)
+        # No awaits in here, so handlers never see a half applied config.
+        for name, (_, val) in changes.items():
+            setattr(self, name, val)
+        self.file_values = new_values
+        return changes
+
     def load_config(self):
         with open(self.filename, "r") as f:
             lines = f.readlines()
         # load the config, verify everything has a value.
         for line in lines:
-            if line.startswith("openaikey"):
-                self.CHAT_GPT_KEY = line[line.find("=") + 1 :].strip("\n").strip()
-            if line.startswith("botkey"):
-                self.BOT_KEY = line[line.find("=") + 1 :].strip("\n").strip()
-            if line.startswith("admin"):
-                self.ADMIN = line[line.find("=") + 1 :].strip("\n").strip()
-            if line.startswith("googlegemini="):
-                self.GEMINI_KEY = line[line.find("=") + 1 :].strip("\n").strip()
-            if line.startswith("allowlistfilename"):
-                self.ALLOW_LIST_FILENAME = (
-                    line[line.find("=") + 1 :].strip("\n").strip()
-                )
-            if line.startswith("useallowlist"):
-                readin = line[line.find("=") + 1 :].strip("\n").strip()
-                if readin.lower().strip() == "true":
-                    self.USE_ALLOW_LIST = True
-                self.logger.info(f"Allow list is set to {self.USE_ALLOW_LIST}")
-            if line.startswith("chatfile"):
-                self.CHAT_FILE = line[line.find("=") + 1 :].strip("\n").strip()
-            if line.startswith("quotefile"):
-                self.QUOTE_FILE = line[line.find("=") + 1 :].strip("\n").strip()
-            if line.startswith("openaimodel"):
-                val = line[line.find("=") + 1 :].strip("\n").strip()
-                self.CHAT_GPT_MODEL = "default" if val == "default" else val #empty means use whats in the code
-            if line.startswith("googlegeminimodel"):
-                val = line[line.find("=") + 1 :].strip("\n").strip()
-                self.GEMINI_MODEL = "default" if val == "default" else val #empty means use whats in the code
+            key, found, val = line.partition("=")
+            setting = SETTINGS.get(key.strip())
+            if not found or setting is None:
+                continue
+            name, reader = setting
+            setattr(self, name, getattr(self, reader)(key.strip(), val.strip(), getattr(self, name)))
+        self.logger.info(f"Allow list is set to {self.USE_ALLOW_LIST}")
+
+    # Readers for SETTINGS: (key, value from the file, current value) -> new value.
+    def read_str(self, key: str, val: str, current: str) -> str:
+        return val
+
+    def read_path(self, key: str, val: str, current: str) -> str:
+        """A file name; left empty it keeps the default."""
+        return val if val else current
+
+    def read_optional_path(self, key: str, val: str, current: str) -> str:
+        """A file name; left empty it turns the file off ("none")."""
+        return val if val else "none"
+
+    def read_bool(self, key: str, val: str, current: bool) -> bool:
+        if val.lower() in ("true", "false"):
+            return val.lower() == "true"
+        self.logger.error(f"Invalid value '{val}' for '{key}' (true/false), using {current}")
+        return current
+
+    def read_choice(self, key: str, val: str, current: str) -> str:
+        val = val.lower()
+        if val in CHOICES[key]:
+            return val
+        self.logger.error(f"Invalid {key} '{val}', using {current}")
+        return current
+
+    def read_int(self, key: str, val: str, current: int) -> int:
+        """Reads a positive integer setting, keeping the current value if the new one is bad."""
+        if val.isnumeric() and int(val) > 0:
+            return int(val)
+        self.logger.error(f"Invalid number '{val}' for '{key}', using {current}")
+        return current
+
+    def read_model_limits(self, key: str, val: str, current: dict) -> dict:
+        """
+        Parses `modellimits=model:concurrent/rpm/tpm, other-model:concurrent/rpm/tpm`
+        into {model: (concurrent, rpm, tpm)}.
+        """
+        limits = {}
+        for entry in val.split(","):
+            entry = entry.strip()
+            if not entry:
+                continue
+            model, _, numbers = entry.rpartition(":")
+            parts = numbers.split("/")
+            if not model or len(parts) != 3 or not all(p.strip().isnumeric() for p in parts):
+                self.logger.error(f"Ignoring invalid model limit '{entry}'")
+                continue
+            limits[model.strip()] = tuple(int(p) for p in parts)
+        return limits
+
+    def read_model_tokens(self, key: str, val: str, current: dict) -> dict:
+        """Parses `modelhistorytokens=model:tokens, other-model:tokens` into {model: tokens}."""
+        budgets = {}
+        for entry in val.split(","):
+            entry = entry.strip()
+            if not entry:
+                continue
+            model, _, tokens = entry.rpartition(":")
+            if not model or not tokens.strip().isnumeric():
+                self.logger.error(f"Ignoring invalid history budget '{entry}'")
+                continue
+            budgets[model.strip()] = int(tokens)
+        return budgets
+
+    def read_model_prices(self, key: str, val: str, current: dict) -> dict:
+        """Parses `modelprices=model:prompt/completion, ...` (USD per million tokens)."""
+        prices = {}
+        for entry in val.split(","):
+            entry = entry.strip()
+            if not entry:
+                continue
+            model, _, numbers = entry.rpartition(":")
+            try:
+                prompt_price, completion_price = (float(p) for p in numbers.split("/"))
+            except ValueError:
+                self.logger.error(f"Ignoring invalid model price '{entry}'")
+                continue
+            if not model:
+                self.logger.error(f"Ignoring invalid model price '{entry}'")
+                continue
+            prices[model.strip()] = (prompt_price, completion_price)
+        return prices
+
+    def quote_files(self) -> list[str]:
+        return [name.strip() for name in self.QUOTE_FILE.split(",") if name.strip()]
+
+    def history_budget(self, model: str) -> int:
+        return self.MODEL_HISTORY_TOKENS.get(model, self.HISTORY_TOKENS)
 
     def verify_config(self):
         """
@@ -104,8 +320,8 @@ class BotConfiguration:
             return False
         
         self.logger.info(f"Saving config file {self.filename}")
-        with open(self.filename, "w") as f:
-            f.writelines(lines_from_config)
+        # Atomic, so the config reloader never reads a half written file.
+        atomic_write(self.filename, "".join(lines_from_config))
         return True
 
         
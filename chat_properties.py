@@ -1,22 +1,43 @@
 # File to save and change the properties of chats that we want to listen to.
+import asyncio
+from dataclasses import asdict, dataclass
 import logging
 import json
 import os
 
+from file_utils import atomic_write
+
+# Seconds to wait for more changes before writing the file.
+SAVE_DELAY = 2.0
+
+
+@dataclass(slots=True)
+class ChatRecord:
+    chat: str
+    model: str
+    listening: bool = False
+    chat_title: str = ""
+
+
 class ChatProperties:
     VALID_MODELS = ["chatgpt", "gemini"]
-    chat_ids = {}
-    # For documentation mostly.
-    ## chat_id_tempate = {
-    ##     "chat": "",
-    ##     "model": VALID_MODELS[0],
-    ##     "listening": False,
-    ##     "chat_title" : "",
-    ## }
-    def __init__(self, logger: logging.Logger):
+
+    def __init__(
+        self,
+        logger: logging.Logger,
+        filename: str = "chat_properties.json",
+        save_delay: float = SAVE_DELAY,
+    ):
         self.logger = logger
+        # Resolved once so a later change of working directory can't move the file.
+        self.filename = os.path.abspath(filename)
+        self.save_delay = save_delay
+        self.chat_ids = {}  # chat id -> ChatRecord
+        # Chats with listening on, checked for every message so kept ready made.
+        self.listening_ids = set()
+        self.pending_save = None  # asyncio.TimerHandle while a save is scheduled
         self.load_chats()
-        
+
     def set_chat(self, chat_id: str="", model: str=None, listening: bool=False, chat_title: str=""):
         if model is None:
             model = self.VALID_MODELS[0]
@@ -25,41 +46,70 @@ class ChatProperties:
             model = self.VALID_MODELS[0]
         if chat_title == None:
             chat_title = ""
-        if chat_id in self.chat_ids:
-            self.chat_ids[chat_id]["model"] = model
-            self.chat_ids[chat_id]["listening"] = listening
-            self.chat_ids[chat_id]["chat_title"] = chat_title
+        record = self.chat_ids.get(chat_id)
+        if record is not None:
+            record.model = model
+            record.listening = listening
+            record.chat_title = chat_title
         else:
-            self.chat_ids[chat_id] = {
-                "chat": chat_id,
-                "model": model,
-                "listening": listening,
-                "chat_title": chat_title,
-            }
-        self.save_chats()
+            self.chat_ids[chat_id] = ChatRecord(chat_id, model, listening, chat_title)
+        if listening:
+            self.listening_ids.add(chat_id)
+        else:
+            self.listening_ids.discard(chat_id)
+        self.schedule_save()
+
+    def schedule_save(self):
+        """Coalesces changes made within save_delay seconds into one write."""
+        if self.pending_save is not None:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # Not inside the bot's event loop (startup, scripts); write right away.
+            self.save_chats()
+            return
+        self.pending_save = loop.call_later(self.save_delay, self.save_chats)
+
+    def flush(self):
+        """Writes any scheduled changes now, used on shutdown."""
+        if self.pending_save is not None:
+            self.pending_save.cancel()
+            self.save_chats()
 
     def save_chats(self):
-        import json
-        self.logger.info("Saving chat properties to JSON")
+        self.pending_save = None
         try:
-            with open("chat_properties.json", "w") as f:
-                json.dump(self.chat_ids, f, indent=2)
-            self.logger.info("Saved chat properties")
+            data = {chat_id: asdict(record) for chat_id, record in self.chat_ids.items()}
+            atomic_write(self.filename, json.dumps(data, separators=(",", ":")))
+            self.logger.info(f"Saved {len(data)} chat properties")
         except Exception as e:
             self.logger.error(f"Error saving chat properties: {e}")
 
     def load_chats(self):
-        if os.path.exists("chat_properties.json"):
+        if os.path.exists(self.filename):
             try:
-                with open("chat_properties.json", "r") as f:
-                    self.chat_ids = json.load(f)
+                with open(self.filename, "r") as f:
+                    saved = json.load(f)
+                self.chat_ids = {
+                    chat_id: ChatRecord(
+                        chat=props.get("chat", chat_id),
+                        model=props.get("model", self.VALID_MODELS[0]),
+                        listening=props.get("listening", False),
+                        chat_title=props.get("chat_title", ""),
+                    )
+                    for chat_id, props in saved.items()
+                }
                 self.logger.info(f"Loaded {len(self.chat_ids)} chat properties")
             except Exception as e:
                 self.logger.error(f"Error loading chat properties: {e}")
                 self.chat_ids = {}
+        self.listening_ids = {
+            chat_id for chat_id, record in self.chat_ids.items() if record.listening
+        }
 
-    def get_chat(self, chat_id: str=""):
-        if chat_id in self.chat_ids:
-            return self.chat_ids[chat_id]
-        else:
-            return None
\ No newline at end of file
+    def get_chat(self, chat_id: str="") -> ChatRecord | None:
+        return self.chat_ids.get(chat_id)
+
+    def is_listening(self, chat_id: str="") -> bool:
+        return chat_id in self.listening_ids
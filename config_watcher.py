@@ -0,0 +1,56 @@
+# Applies edits to keys.txt and the allow list without restarting the bot.
+import asyncio
+import inspect
+import logging
+import os
+
+
+class ConfigWatcher:
+    """
+    Polls the modification time and size of watched files and calls their reload callback
+    when either changes.  Callbacks may be plain or async functions.  A file only counts
+    as seen once its callback succeeds, so a failing one is retried on every check; the
+    error is logged once per version of the file.
+    """
+
+    def __init__(self, logger: logging.Logger, interval: float = 5.0) -> None:
+        self.logger = logger.getChild("config_watcher")
+        self.interval = interval
+        self.watched = {}  # filename -> [signature, callback, signature that last failed]
+
+    @staticmethod
+    def signature(filename: str) -> tuple | None:
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def watch(self, filename: str, callback) -> None:
+        self.watched[filename] = [self.signature(filename), callback, None]
+
+    def unwatch(self, filename: str) -> None:
+        self.watched.pop(filename, None)
+
+    async def check(self) -> None:
+        # A callback may change what is watched, so go over a copy.
+        for filename, entry in list(self.watched.items()):
+            current = self.signature(filename)
+            if current is None or current == entry[0]:
+                continue
+            try:
+                result = entry[1]()
+                if inspect.isawaitable(result):
+                    await result
+            except Exception as e:
+                if entry[2] != current:
+                    self.logger.error(f"Not reloading {filename}, the new version was rejected: {e}")
+                entry[2] = current
+                continue
+            entry[0], entry[2] = current, None
+
+    async def run(self) -> None:
+        # Background task, started in startup_services.
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.check()
@@ -0,0 +1,247 @@
+# Keeps the recent conversation per user and chat so prompts can carry real history.
+import asyncio
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+from itertools import islice
+import logging
+from typing import Optional
+
+from gpt import estimate_tokens
+from user_store import UserStore
+
+# How much of a dropped exchange is kept in the running summary.
+SUMMARY_SNIPPET_CHARS = 200
+# Exchanges past max_turns that stay in the store, to rebuild the summary after a restart.
+SUMMARIZED_EXCHANGES_KEPT = 10
+
+
+@dataclass(slots=True)
+class Exchange:
+    """One prompt and its answer, with the provider messages built once up front."""
+
+    prompt: str
+    answer: str
+    tokens: int
+    openai: tuple
+    gemini: tuple
+
+    @classmethod
+    def create(cls, prompt: str, answer: str) -> "Exchange":
+        return cls(
+            prompt=prompt,
+            answer=answer,
+            tokens=estimate_tokens(prompt) + estimate_tokens(answer),
+            openai=(
+                {"role": "user", "content": prompt},
+                {"role": "assistant", "content": answer},
+            ),
+            gemini=(
+                {"role": "user", "parts": [prompt]},
+                {"role": "model", "parts": [answer]},
+            ),
+        )
+
+
+@dataclass(slots=True)
+class Conversation:
+    exchanges: deque = field(default_factory=deque)
+    # Short notes about exchanges that no longer fit, oldest first.
+    summary: deque = field(default_factory=deque)
+    summary_tokens: int = 0
+    version: int = 0
+    # (format, token budget) -> (version, assembled messages)
+    assembled: dict = field(default_factory=dict)
+
+
+class ConversationStore:
+    """
+    Per (chat, user) history of the last `max_turns` exchanges.  Older exchanges are folded
+    into a short running summary instead of being resent in full, and the history handed
+    to a model is trimmed to that model's token budget.  Assembled histories are cached
+    until the conversation changes.
+
+    With a store, exchanges are also written to the database in batches (see flush()) and
+    conversations not in memory are loaded from it, so history survives a restart.
+    """
+
+    def __init__(
+        self,
+        logger: logging.Logger,
+        max_turns: int = 10,
+        summary_tokens: int = 400,
+        max_conversations: int = 2000,
+        store: Optional[UserStore] = None,
+    ) -> None:
+        self.logger = logger.getChild("conversation")
+        self.max_turns = max_turns
+        self.summary_tokens = summary_tokens
+        self.max_conversations = max_conversations
+        self.store = store
+        # Least recently used first.
+        self.conversations = OrderedDict()
+        # Changes not written yet, in order: (chat id, user id, prompt, answer), prompt None
+        # for a clear.  Conversations with unsaved or in flight changes stay in memory, so
+        # the store only gets read for conversations it's up to date on.
+        self.unsaved = []
+        self.in_flight = set()
+
+    @staticmethod
+    def key(chat_id: int | str, user_id: int | str | None) -> tuple[str, str]:
+        return str(chat_id), "" if user_id is None else str(user_id)
+
+    def get(self, chat_id, user_id) -> Conversation | None:
+        key = self.key(chat_id, user_id)
+        conversation = self.conversations.get(key)
+        if conversation is not None:
+            self.conversations.move_to_end(key)
+            return conversation
+        conversation = self.load(key)
+        if conversation is not None:
+            self.keep(key, conversation)
+        return conversation
+
+    def load(self, key: tuple[str, str]) -> Conversation | None:
+        if self.store is None:
+            return None
+        try:
+            saved = self.store.load_exchanges(*key, self.max_turns + SUMMARIZED_EXCHANGES_KEPT)
+        except Exception as e:
+            self.logger.error(f"Error loading conversation {key}, starting fresh: {e}")
+            return None
+        if not saved:
+            return None
+        conversation = Conversation()
+        for prompt, answer in saved:
+            self.append(conversation, prompt, answer)
+        return conversation
+
+    def keep(self, key: tuple[str, str], conversation: Conversation) -> None:
+        """Holds `conversation` in memory, dropping the least recently used saved ones."""
+        self.conversations[key] = conversation
+        over = len(self.conversations) - self.max_conversations
+        if over <= 0:
+            return
+        busy = {change[:2] for change in self.unsaved} | self.in_flight | {key}
+        for old in list(islice((k for k in self.conversations if k not in busy), over)):
+            del self.conversations[old]
+
+    def add_exchange(self, chat_id, user_id, prompt: str, answer: str) -> None:
+        key = self.key(chat_id, user_id)
+        conversation = self.get(chat_id, user_id)
+        if conversation is None:
+            conversation = Conversation()
+            self.keep(key, conversation)
+        self.append(conversation, prompt, answer)
+        if self.store is not None:
+            self.unsaved.append((*key, prompt, answer))
+
+    def append(self, conversation: Conversation, prompt: str, answer: str) -> None:
+        conversation.exchanges.append(Exchange.create(prompt, answer))
+        while len(conversation.exchanges) > self.max_turns:
+            self.summarize(conversation, conversation.exchanges.popleft())
+        conversation.version += 1
+        conversation.assembled.clear()
+
+    def summarize(self, conversation: Conversation, exchange: Exchange) -> None:
+        # Incremental and free: keep the start of each side, drop the oldest notes when full.
+        note = (
+            f"I asked: {exchange.prompt[:SUMMARY_SNIPPET_CHARS]} / "
+            f"you answered: {exchange.answer[:SUMMARY_SNIPPET_CHARS]}"
+        )
+        conversation.summary.append(note)
+        conversation.summary_tokens += estimate_tokens(note)
+        while conversation.summary_tokens > self.summary_tokens and len(conversation.summary) > 1:
+            conversation.summary_tokens -= estimate_tokens(conversation.summary.popleft())
+
+    def clear(self, chat_id, user_id) -> None:
+        key = self.key(chat_id, user_id)
+        self.conversations.pop(key, None)
+        if self.store is not None:
+            # An empty conversation stands in until the clear is written, so the old
+            # exchanges aren't loaded back from the store in the meantime.
+            self.keep(key, Conversation())
+            self.unsaved.append((*key, None, None))
+
+    def take_unsaved(self) -> list[tuple]:
+        """The changes to write, moved to in_flight; call written() once they're done."""
+        changes, self.unsaved = self.unsaved, []
+        self.in_flight.update(change[:2] for change in changes)
+        return changes
+
+    def written(self, changes: list[tuple], saved: bool) -> None:
+        self.in_flight.difference_update(change[:2] for change in changes)
+        if not saved:
+            # Try again next time, ahead of anything that came in since.
+            self.unsaved[:0] = changes
+
+    def save(self) -> None:
+        """Writes the unsaved exchanges to the store (blocking)."""
+        if self.store is None or not self.unsaved:
+            return
+        changes = self.take_unsaved()
+        saved = False
+        try:
+            self.store.save_exchanges(changes, self.max_turns + SUMMARIZED_EXCHANGES_KEPT)
+            saved = True
+        finally:
+            self.written(changes, saved)
+
+    async def flush(self) -> None:
+        """Same as save(), but the database write happens off the event loop."""
+        if self.store is None or not self.unsaved:
+            return
+        changes = self.take_unsaved()
+        saved = False
+        try:
+            await asyncio.to_thread(
+                self.store.save_exchanges, changes, self.max_turns + SUMMARIZED_EXCHANGES_KEPT
+            )
+            saved = True
+        finally:
+            self.written(changes, saved)
+
+    async def run_saver(self, interval: int) -> None:
+        # Background task: batch the new exchanges into one write every `interval` seconds.
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                self.logger.error(f"Error saving conversations: {e}")
+
+    def history(self, chat_id, user_id, budget: int, style: str = "openai") -> list[dict]:
+        """
+        Role tagged messages for `style` ("openai" or "gemini"), newest exchanges first to
+        go in, that fit in `budget` tokens.  Empty when there is no history.
+        """
+        conversation = self.get(chat_id, user_id)
+        if conversation is None:
+            return []
+        cached = conversation.assembled.get((style, budget))
+        if cached is not None and cached[0] == conversation.version:
+            return cached[1]
+
+        picked = []
+        used = 0
+        for exchange in reversed(conversation.exchanges):
+            if used + exchange.tokens > budget:
+                break
+            picked.append(exchange)
+            used += exchange.tokens
+        messages = []
+        if conversation.summary and used + conversation.summary_tokens <= budget:
+            summary = "Summary of our earlier conversation: " + " | ".join(conversation.summary)
+            if style == "gemini":
+                messages += [
+                    {"role": "user", "parts": [summary]},
+                    {"role": "model", "parts": ["OK."]},
+                ]
+            else:
+                messages += [
+                    {"role": "user", "content": summary},
+                    {"role": "assistant", "content": "OK."},
+                ]
+        for exchange in reversed(picked):
+            messages.extend(exchange.gemini if style == "gemini" else exchange.openai)
+        conversation.assembled[(style, budget)] = (conversation.version, messages)
+        return messages
@@ -0,0 +1,25 @@
+# Small helpers for writing files safely.
+import os
+import tempfile
+
+
+def atomic_write(filename: str, data: str | bytes) -> None:
+    """
+    Writes `data` to a temporary file next to `filename` and renames it into place, so
+    readers only ever see the old or the new file and never a half written one.
+    """
+    directory = os.path.dirname(os.path.abspath(filename))
+    mode = "wb" if isinstance(data, bytes) else "w"
+    fd, tmp_name = tempfile.mkstemp(dir=directory, prefix=".tmp_", suffix=os.path.basename(filename))
+    try:
+        with os.fdopen(fd, mode) as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_name, filename)
+    except BaseException:
+        try:
+            os.remove(tmp_name)
+        except OSError:
+            pass
+        raise
@@ -1,50 +1,642 @@
+from aiolimiter import AsyncLimiter
+import asyncio
+import contextlib
+from email.utils import parsedate_to_datetime
+import httpx
 import openai
 import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
 import logging
+import random
+import time
 
 from app_config import BotConfiguration
+from response_cache import ResponseCache
+from usage import IMAGE_PRICES, UsageTracker
 
 
-class LLM_ACCESS:
+# Connection pool sizing for the shared OpenAI HTTP client.
+OPENAI_MAX_CONNECTIONS = 20
+OPENAI_MAX_KEEPALIVE = 10
+OPENAI_KEEPALIVE_EXPIRY = 60.0
+OPENAI_TIMEOUT = httpx.Timeout(120.0, connect=10.0)
+
+GEMINI_GENERATION_CONFIG = {
+    "temperature": 0.9,
+    "top_p": 1,
+    "top_k": 1,
+    "max_output_tokens": 2048,
+}
+# https://ai.google.dev/docs/safety_setting_gemini
+GEMINI_SAFETY_SETTINGS = [
+    {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
+    {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_NONE"},
+    {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_NONE"},
+    {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"},
+]
+
+
+# HTTP statuses worth another try: timeouts, conflicts, rate limits and server errors.
+RETRYABLE_STATUS_CODES = {408, 409, 429}
+
+
+class LLMDeadlineExceeded(Exception):
+    pass
+
+
+class RetryPolicy:
+    """
+    Exponential backoff with full jitter.  Every call gets `deadline` seconds in total,
+    spread over at most `max_attempts` tries.
+    """
+
+    def __init__(
+        self, max_attempts=4, base_delay=1.0, max_delay=30.0, deadline=120.0
+    ) -> None:
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+
+    def backoff(self, attempt: int, retry_after: float | None = None) -> float:
+        ceiling = min(self.max_delay, self.base_delay * (2 ** (attempt - 1)))
+        delay = random.uniform(0, ceiling)
+        if retry_after is not None:
+            # The provider told us when to come back; never go earlier than that.
+            delay = max(delay, retry_after)
+        return delay
+
+
+def parse_retry_after(headers) -> float | None:
+    if headers is None:
+        return None
+    value = headers.get("retry-after-ms")
+    if value:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def classify_error(error: Exception) -> tuple[bool, float | None]:
+    """
+    Decides if an exception from a provider is worth retrying.  Returns a tuple of
+    (retryable, retry_after seconds or None).
+    """
+    if isinstance(error, (asyncio.TimeoutError, openai.APIConnectionError)):
+        # APITimeoutError is a subclass of APIConnectionError.
+        return True, None
+    if isinstance(error, openai.APIStatusError):
+        status = error.status_code
+        retryable = status in RETRYABLE_STATUS_CODES or status >= 500
+        return retryable, parse_retry_after(error.response.headers)
+    if isinstance(
+        error,
+        (
+            google_exceptions.TooManyRequests,
+            google_exceptions.ResourceExhausted,
+            google_exceptions.InternalServerError,
+            google_exceptions.ServiceUnavailable,
+            google_exceptions.GatewayTimeout,
+            google_exceptions.DeadlineExceeded,
+        ),
+    ):
+        return True, None
+    if isinstance(error, google_exceptions.GoogleAPICallError):
+        status = error.code if isinstance(error.code, int) else 0
+        return status in RETRYABLE_STATUS_CODES or status >= 500, None
+    # Anything else (bad request, auth, blocked content, ...) won't get better by retrying.
+    return False, None
+
+
+def request_not_sent(error: Exception) -> bool:
+    """
+    True when the provider can't have started working on the request: the connection was
+    never made, or it was turned away with a 429.  Only these are safe to retry for calls
+    that are billed even when we stop waiting for the answer (image generation).
+    """
+    if isinstance(error, openai.APIConnectionError):
+        return isinstance(
+            error.__cause__, (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+        )
+    return isinstance(error, openai.APIStatusError) and error.status_code == 429
+
+
+# Tokens reserved for the completion when a request is counted against a TPM budget.
+COMPLETION_TOKEN_RESERVE = 512
+
+
+def estimate_tokens(text: str) -> int:
+    # Roughly four characters per token for English text; good enough for budgeting.
+    return max(1, len(text) // 4)
+
+
+def history_tokens(messages: list[dict] | None) -> int:
+    """Token estimate for OpenAI style ("content") or Gemini style ("parts") messages."""
+    if not messages:
+        return 0
+    return sum(
+        estimate_tokens(m.get("content") or "".join(m.get("parts", ()))) for m in messages
+    )
+
+
+class RateLimitTimeout(Exception):
+    pass
+
+
+class ModelLimiter:
+    """Concurrency, request and token budgets for one (provider, model) pair."""
+
+    def __init__(self, max_concurrent: int, rpm: int, tpm: int) -> None:
+        self.max_concurrent = max_concurrent
+        self.tpm = tpm
+        self.concurrency = asyncio.Semaphore(max_concurrent)
+        self.requests = AsyncLimiter(rpm, 60)
+        self.tokens = AsyncLimiter(tpm, 60)
+        # asyncio.Lock wakes waiters in arrival order, which keeps the buckets fair.
+        self.gate = asyncio.Lock()
+        self.waiting = 0
+
+
+class RateLimiter:
     def __init__(self, config: BotConfiguration, logger: logging.Logger) -> None:
+        self.config = config
+        self.logger = logger
+        self.limiters = {}
+
+    def limits_for(self, provider: str, model: str) -> tuple[int, int, int]:
+        if model in self.config.MODEL_LIMITS:
+            return self.config.MODEL_LIMITS[model]
+        if provider == "gemini":
+            return (
+                self.config.GEMINI_MAX_CONCURRENT,
+                self.config.GEMINI_RPM,
+                self.config.GEMINI_TPM,
+            )
+        return (
+            self.config.OPENAI_MAX_CONCURRENT,
+            self.config.OPENAI_RPM,
+            self.config.OPENAI_TPM,
+        )
+
+    def limiter_for(self, provider: str, model: str) -> ModelLimiter:
+        key = (provider, model)
+        if key not in self.limiters:
+            self.limiters[key] = ModelLimiter(*self.limits_for(provider, model))
+        return self.limiters[key]
+
+    def reset(self) -> None:
+        """Drops the limiters so new limits from the config apply to the next request."""
+        self.limiters.clear()
+
+    async def acquire(self, limiter: ModelLimiter, tokens: int) -> None:
+        async with limiter.gate:
+            await limiter.requests.acquire()
+            if tokens:
+                await limiter.tokens.acquire(min(tokens, limiter.tpm))
+        await limiter.concurrency.acquire()
+
+    @contextlib.asynccontextmanager
+    async def slot(self, provider: str, model: str, tokens: int = 0):
+        """
+        Waits (in arrival order) until the model has a free concurrent slot and enough
+        request/token budget.  Raises RateLimitTimeout if that takes too long.
+        """
+        limiter = self.limiter_for(provider, model)
+        limiter.waiting += 1
+        try:
+            await asyncio.wait_for(
+                self.acquire(limiter, tokens), timeout=self.config.LLM_QUEUE_TIMEOUT
+            )
+        except asyncio.TimeoutError:
+            self.logger.warning(
+                f" {provider} ({model}) queue wait over {self.config.LLM_QUEUE_TIMEOUT}s, "
+                f"{limiter.waiting} requests waiting"
+            )
+            raise RateLimitTimeout(
+                f"Too many requests for {model} right now, please try again shortly."
+            )
+        finally:
+            limiter.waiting -= 1
+        try:
+            yield
+        finally:
+            limiter.concurrency.release()
+
+
+class LLM_ACCESS:
+    def __init__(
+        self,
+        config: BotConfiguration,
+        logger: logging.Logger,
+        cache: ResponseCache | None = None,
+        usage: UsageTracker | None = None,
+    ) -> None:
         self.logger = logger
         self.config = config
+        # Optional cache for prompts sent without any conversation context.
+        self.cache = cache
+        # Optional token and cost accounting.
+        self.usage = usage
+        self.openai_client = None
+        # GenerativeModel instances keyed by (model name, generation config items)
+        self.gemini_models = {}
+        self.retry_policy = RetryPolicy()
+        # Per provider: calls, total attempts, failures and a histogram of attempts per call.
+        self.retry_stats = {}
+        self.rate_limiter = RateLimiter(config, logger)
+        # Clients replaced by reset_clients() and the tasks that close them
+        self.retired_clients = set()
+        self.closing = set()
+        self.create_clients()
+
+    def create_clients(self) -> None:
+        """
+        Builds the long-lived provider clients.  OpenAI gets one AsyncOpenAI on top of a
+        keep-alive httpx pool and Gemini is configured once so the SDK keeps its cached
+        gRPC channel between requests.
+        """
+        http_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=OPENAI_MAX_CONNECTIONS,
+                max_keepalive_connections=OPENAI_MAX_KEEPALIVE,
+                keepalive_expiry=OPENAI_KEEPALIVE_EXPIRY,
+            ),
+            timeout=OPENAI_TIMEOUT,
+        )
+        self.openai_client = openai.AsyncOpenAI(
+            api_key=self.config.CHAT_GPT_KEY,
+            http_client=http_client,
+            max_retries=0,  # retries are handled by with_retry()
+        )
+        genai.configure(api_key=self.config.GEMINI_KEY)
+        self.gemini_models.clear()
+        self.logger.info("LLM provider clients created.")
+
+    async def close(self) -> None:
+        for task in list(self.closing):
+            task.cancel()
+        await asyncio.gather(*self.closing, return_exceptions=True)
+        for client in self.retired_clients:
+            await client.close()
+        self.retired_clients.clear()
+        if self.openai_client is not None:
+            await self.openai_client.close()
+            self.openai_client = None
+        self.gemini_models.clear()
+
+    async def reset_clients(self) -> None:
+        """
+        Replaces the provider clients, e.g. after an API key change.  Updates are handled
+        concurrently, so requests may still be running on the old OpenAI client; it is
+        closed once they've had the client timeout to finish.
+        """
+        old_client = self.openai_client
+        self.create_clients()
+        if old_client is not None:
+            self.retired_clients.add(old_client)
+            task = asyncio.create_task(self.close_later(old_client, OPENAI_TIMEOUT.read))
+            self.closing.add(task)
+            task.add_done_callback(self.closing.discard)
+
+    async def close_later(self, client: openai.AsyncOpenAI, delay: float) -> None:
+        await asyncio.sleep(delay)
+        self.retired_clients.discard(client)
+        await client.close()
+
+    def record_attempts(self, provider: str, attempts: int, failed: bool) -> None:
+        stats = self.retry_stats.setdefault(
+            provider, {"calls": 0, "attempts": 0, "failures": 0, "histogram": {}}
+        )
+        stats["calls"] += 1
+        stats["attempts"] += attempts
+        if failed:
+            stats["failures"] += 1
+        stats["histogram"][attempts] = stats["histogram"].get(attempts, 0) + 1
+
+    def retry_summary(self) -> str:
+        """One line per provider for /sys, e.g. "openai: 12 calls | 1.2 tries avg | 1 failed"."""
+        lines = []
+        for provider, stats in sorted(self.retry_stats.items()):
+            average = stats["attempts"] / stats["calls"] if stats["calls"] else 0
+            lines.append(
+                f"{provider}: {stats['calls']} calls | {average:.1f} tries avg | {stats['failures']} failed"
+            )
+        return "\n".join(lines)
+
+    def retry_delay(
+        self, provider: str, model: str, error: Exception, attempt: int, started: float,
+        unsent_only: bool = False,
+    ) -> float | None:
+        """
+        Returns how long to wait before the next attempt, or None to give up.  With
+        `unsent_only` only errors from requests that never reached the provider are retried.
+        """
+        policy = self.retry_policy
+        retryable, retry_after = classify_error(error)
+        if unsent_only and not request_not_sent(error):
+            retryable = False
+        if not retryable or attempt >= policy.max_attempts:
+            self.logger.error(
+                f" {provider} failed with {error} on try {attempt}, using model {model} (giving up)"
+            )
+            self.record_attempts(provider, attempt, failed=True)
+            return None
+        delay = policy.backoff(attempt, retry_after)
+        if time.monotonic() - started + delay >= policy.deadline:
+            self.logger.error(
+                f" {provider} failed with {error} on try {attempt}, using model {model} (no time left to retry)"
+            )
+            self.record_attempts(provider, attempt, failed=True)
+            return None
+        self.logger.warning(
+            f" {provider} failed with {error} on try {attempt}, using model {model}; retrying in {delay:.1f}s"
+        )
+        return delay
+
+    async def with_retry(
+        self, provider: str, model: str, call, tokens: int = 0, unsent_only: bool = False
+    ):
+        """
+        Runs `call` (a coroutine function) under the retry policy.  Retryable errors are
+        retried with backoff until attempts or the deadline run out; fatal errors are raised
+        straight away.  Every attempt waits for a rate limiter slot first.  Pass
+        `unsent_only` for calls that mustn't run twice (see request_not_sent).
+        """
+        policy = self.retry_policy
+        started = time.monotonic()
+        attempt = 0
+        while True:
+            attempt += 1
+            remaining = policy.deadline - (time.monotonic() - started)
+            if remaining <= 0:
+                self.record_attempts(provider, attempt - 1, failed=True)
+                raise LLMDeadlineExceeded(
+                    f"{provider} ({model}) gave no answer within {policy.deadline}s"
+                )
+            try:
+                async with self.rate_limiter.slot(provider, model, tokens):
+                    result = await asyncio.wait_for(call(), timeout=remaining)
+            except Exception as e:
+                delay = self.retry_delay(provider, model, e, attempt, started, unsent_only)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                continue
+            self.record_attempts(provider, attempt, failed=False)
+            self.logger.info(
+                f"   * {provider} responded on try {attempt}",
+                extra={"latency": round(time.monotonic() - started, 3)},
+            )
+            return result
+
+    async def stream_with_retry(self, provider: str, model: str, open_stream, tokens: int = 0):
+        """
+        Streaming counterpart of with_retry().  `open_stream` is a coroutine function returning
+        an async iterator of text pieces.  Attempts are only retried until the first piece
+        has been yielded; after that an error is raised to the caller as-is.  The rate limiter
+        slot is held until the stream ends.
+        """
+        policy = self.retry_policy
+        started = time.monotonic()
+        attempt = 0
+        while True:
+            attempt += 1
+            remaining = policy.deadline - (time.monotonic() - started)
+            if remaining <= 0:
+                self.record_attempts(provider, attempt - 1, failed=True)
+                raise LLMDeadlineExceeded(
+                    f"{provider} ({model}) gave no answer within {policy.deadline}s"
+                )
+            emitted = False
+            try:
+                async with self.rate_limiter.slot(provider, model, tokens):
+                    pieces = await asyncio.wait_for(open_stream(), timeout=remaining)
+                    # Closed right away if our caller stops early, which frees the slot.
+                    async with contextlib.aclosing(pieces):
+                        async for piece in pieces:
+                            if piece:
+                                emitted = True
+                                yield piece
+            except Exception as e:
+                if emitted:
+                    self.logger.error(f" {provider} stream broke with {e}, using model {model}")
+                    self.record_attempts(provider, attempt, failed=True)
+                    raise
+                delay = self.retry_delay(provider, model, e, attempt, started)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                continue
+            self.record_attempts(provider, attempt, failed=False)
+            self.logger.info(
+                f"   * {provider} finished streaming on try {attempt}",
+                extra={"latency": round(time.monotonic() - started, 3)},
+            )
+            return
+
+    def cache_key(self, use_cache: bool, message: str, model: str, temp, system_is="") -> str | None:
+        if self.cache is None or not use_cache:
+            return None
+        return self.cache.make_key(message, model, temp, system_is)
 
-    def gpt_4(
-        self, message="", prev_sub="", system_is="You are a helpful assistant.", 
-        temp=1, openAI_model="gpt-4o"
+    async def cached_stream(self, key: str | None, pieces):
+        """Serves a stream from the cache on a hit, and fills the cache on a miss."""
+        if key is not None:
+            cached = self.cache.get(key)
+            if cached is not None:
+                yield cached
+                return
+        collected = []
+        async with contextlib.aclosing(pieces):
+            async for piece in pieces:
+                collected.append(piece)
+                yield piece
+        if key is not None:
+            self.cache.put(key, "".join(collected))
+
+    def record_usage(
+        self, provider: str, model: str, prompt_tokens: int, completion_tokens: int,
+        started: float, user_id=None, chat_id=None, estimated=False,
+    ) -> None:
+        if self.usage is None:
+            return
+        self.usage.record(
+            provider, model, prompt_tokens, completion_tokens, time.monotonic() - started,
+            user_id=user_id, chat_id=chat_id, estimated=estimated,
+        )
+
+    async def metered_stream(
+        self, provider: str, model: str, pieces, prompt_tokens: int, user_id=None, chat_id=None
     ):
-        openai.api_key = self.config.CHAT_GPT_KEY
+        """
+        Passes a stream through and records its usage once it ends.  Streams don't report
+        token counts, so the completion is estimated from the text.
+        """
+        started = time.monotonic()
+        completion_tokens = 0
+        async with contextlib.aclosing(pieces):
+            async for piece in pieces:
+                completion_tokens += len(piece)
+                yield piece
+        self.record_usage(
+            provider, model, prompt_tokens, max(1, completion_tokens // 4), started,
+            user_id, chat_id, estimated=True,
+        )
+
+    def get_gemini_model(
+        self, model_name: str, generation_config: dict, safety_settings: list
+    ) -> genai.GenerativeModel:
+        key = (model_name, tuple(sorted(generation_config.items())))
+        model = self.gemini_models.get(key)
+        if model is None:
+            model = genai.GenerativeModel(
+                model_name=model_name,
+                generation_config=generation_config,
+                safety_settings=safety_settings,
+            )
+            self.gemini_models[key] = model
+        return model
+
+    async def gpt_4(
+        self, message="", prev_sub="", system_is="You are a helpful assistant.",
+        temp=1, openAI_model="gpt-4o", use_cache=False, history=None,
+        user_id=None, chat_id=None,
+    ):
+        client = self.openai_client
         if message:
-            try_counter = 0
-            MAX_TRIES = 4
-            while try_counter < MAX_TRIES:
-                try:
-                    response = openai.chat.completions.create(
-                        # model="gpt-4",
-                        model=openAI_model,
-                        # temperature=temp,
-                        messages=[
-                            #{"role": "system", "content": system_is}, # TEMP DISABLED FOR USING PREVIEW MODELS
-                            {"role": "assistant", "content": prev_sub},
-                            {"role": "user", "content": message},
-                        ],
-                    )
-                    self.logger.info(f"   * GPT responded with try {try_counter}")
-                    return response.choices[0].message.content
-                except Exception as e:
-                    self.logger.error(f" GPT failed with {e} on try {try_counter}, using model {openAI_model}")
-                    try_counter += 1
-            # if we get here, throw an error:
-            raise Exception("Failure while sending to ChatGPT: ")
+            key = self.cache_key(
+                use_cache and not prev_sub and not history, message, openAI_model, temp, system_is
+            )
+            if key is not None:
+                cached = self.cache.get(key)
+                if cached is not None:
+                    self.logger.info("   * GPT answer served from cache")
+                    return cached
+
+            messages = self.openai_messages(message, prev_sub, system_is, history)
+
+            async def call():
+                response = await client.chat.completions.create(
+                    # model="gpt-4",
+                    model=openAI_model,
+                    # temperature=temp,
+                    messages=messages,
+                )
+                return response
+
+            prompt_tokens = history_tokens(messages)
+            started = time.monotonic()
+            try:
+                tokens = prompt_tokens + COMPLETION_TOKEN_RESERVE
+                response = await self.with_retry("openai", openAI_model, call, tokens)
+            except Exception as e:
+                raise Exception(f"Failure while sending to ChatGPT: {e}") from e
+            answer = response.choices[0].message.content
+            if response.usage is not None:
+                self.record_usage(
+                    "openai", openAI_model, response.usage.prompt_tokens,
+                    response.usage.completion_tokens, started, user_id, chat_id,
+                )
+            else:
+                self.record_usage(
+                    "openai", openAI_model, prompt_tokens, estimate_tokens(answer or ""),
+                    started, user_id, chat_id, estimated=True,
+                )
+            if key is not None:
+                self.cache.put(key, answer)
+            return answer
         else:
             return "Sorry, but did you mean to say something?"
 
-    def dall_E_3(self, message: str, size="1024x1024", quality="standard"):
-        openai.api_key = self.config.CHAT_GPT_KEY
+    async def gpt_4_stream(
+        self, message="", prev_sub="", system_is="You are a helpful assistant.",
+        temp=1, openAI_model="gpt-4o", use_cache=False, history=None,
+        user_id=None, chat_id=None,
+    ):
+        """Same as gpt_4() but yields the answer in pieces as they arrive."""
+        client = self.openai_client
+        if not message:
+            yield "Sorry, but did you mean to say something?"
+            return
+        messages = self.openai_messages(message, prev_sub, system_is, history)
+
+        async def open_stream():
+            stream = await client.chat.completions.create(
+                model=openAI_model,
+                messages=messages,
+                stream=True,
+            )
+
+            async def pieces():
+                try:
+                    async for chunk in stream:
+                        if chunk.choices and chunk.choices[0].delta.content:
+                            yield chunk.choices[0].delta.content
+                finally:
+                    # Hands the connection back to the pool when stopped early.
+                    await stream.response.aclose()
+
+            return pieces()
+
+        prompt_tokens = history_tokens(messages)
+        key = self.cache_key(
+            use_cache and not prev_sub and not history, message, openAI_model, temp, system_is
+        )
+        pieces = self.metered_stream(
+            "openai", openAI_model,
+            self.stream_with_retry(
+                "openai", openAI_model, open_stream, prompt_tokens + COMPLETION_TOKEN_RESERVE
+            ),
+            prompt_tokens, user_id, chat_id,
+        )
+        try:
+            async with contextlib.aclosing(self.cached_stream(key, pieces)) as stream:
+                async for piece in stream:
+                    yield piece
+        except Exception as e:
+            raise Exception(f"Failure while sending to ChatGPT: {e}") from e
+
+    def openai_messages(
+        self, message: str, prev_sub: str, system_is: str, history: list[dict] = None
+    ) -> list[dict]:
+        if history:
+            # Earlier turns already carry their own roles.
+            messages = list(history)
+            if prev_sub:
+                messages.append({"role": "assistant", "content": prev_sub})
+            messages.append({"role": "user", "content": message})
+            return messages
+        return [
+            #{"role": "system", "content": system_is}, # TEMP DISABLED FOR USING PREVIEW MODELS
+            {"role": "assistant", "content": prev_sub},
+            {"role": "user", "content": message},
+        ]
+
+    @staticmethod
+    def gemini_contents(message: str, history: list[dict] = None):
+        if not history:
+            return message
+        return [*history, {"role": "user", "parts": [message]}]
+
+    async def dall_E_3(
+        self, message: str, size="1024x1024", quality="standard", user_id=None, chat_id=None
+    ):
+        client = self.openai_client
         if message and size in ["1024x1024", "1792x1024", "1024x1792"]:
-            try:
-                response = openai.images.generate(
+            async def call():
+                response = await client.images.generate(
                     model="dall-e-3",
                     prompt=message,
                     n=1,
@@ -52,47 +644,108 @@ class LLM_ACCESS:
                     quality=quality,
                 )
                 return response.data[0].url
+
+            started = time.monotonic()
+            try:
+                # A generation that timed out on our side may still finish and be billed,
+                # so only retry when the request never got through.
+                url = await self.with_retry("openai", "dall-e-3", call, unsent_only=True)
+                if self.usage is not None:
+                    self.usage.record(
+                        "openai", "dall-e-3", estimate_tokens(message), 0,
+                        time.monotonic() - started, user_id=user_id, chat_id=chat_id,
+                        cost=IMAGE_PRICES.get((quality, size), 0.0),
+                    )
+                return url
             except Exception as e:
                 self.logger.error(f" Dall-E3 failed with {e}")
         return "Sorry but there's nothing to go by here."
-    
-    def get_openai_models(self) -> list[str]:
-        openai.api_key = self.config.CHAT_GPT_KEY
-        res = openai.models.list()
+
+    async def get_openai_models(self) -> list[str]:
+        res = await self.openai_client.models.list()
         model_names = [model.id for model in res.data]
         return model_names
-        
-    def google_gemini(self, message: str, model_to_use = "gemini-1.5-pro-latest"):
-        genai.configure(api_key=self.config.GEMINI_KEY)
-        generation_config = {
-            "temperature": 0.9,
-            "top_p": 1,
-            "top_k": 1,
-            "max_output_tokens": 2048,
-        }
-        # https://ai.google.dev/docs/safety_setting_gemini
-        safety_settings = [
-            {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
-            {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_NONE"},
-            {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_NONE"},
-            {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"},
-        ]
-        model = genai.GenerativeModel(
-            model_name=model_to_use,
-            generation_config=generation_config,
-            safety_settings=safety_settings,
+
+    async def google_gemini(
+        self, message: str, model_to_use = "gemini-1.5-pro-latest", use_cache=False,
+        history=None, user_id=None, chat_id=None,
+    ):
+        temperature = GEMINI_GENERATION_CONFIG["temperature"]
+        key = self.cache_key(use_cache and not history, message, model_to_use, temperature)
+        if key is not None:
+            cached = self.cache.get(key)
+            if cached is not None:
+                self.logger.info("   * Gemini answer served from cache")
+                return cached
+        model = self.get_gemini_model(
+            model_to_use, GEMINI_GENERATION_CONFIG, GEMINI_SAFETY_SETTINGS
+        )
+        contents = self.gemini_contents(message, history)
+
+        async def call():
+            response = await model.generate_content_async(contents)
+            # .text raises for blocked prompts, which classify_error treats as fatal.
+            return response, response.text
+
+        prompt_tokens = history_tokens(history) + estimate_tokens(message)
+        started = time.monotonic()
+        response, answer = await self.with_retry(
+            "gemini", model_to_use, call, prompt_tokens + COMPLETION_TOKEN_RESERVE
+        )
+        # Older SDK versions don't report usage; estimate then.
+        metadata = getattr(response, "usage_metadata", None)
+        if metadata is not None:
+            self.record_usage(
+                "gemini", model_to_use, metadata.prompt_token_count,
+                metadata.candidates_token_count, started, user_id, chat_id,
+            )
+        else:
+            self.record_usage(
+                "gemini", model_to_use, prompt_tokens, estimate_tokens(answer), started,
+                user_id, chat_id, estimated=True,
+            )
+        if key is not None:
+            self.cache.put(key, answer)
+        return answer
+
+    async def google_gemini_stream(
+        self, message: str, model_to_use = "gemini-1.5-pro-latest", use_cache=False,
+        history=None, user_id=None, chat_id=None,
+    ):
+        """Same as google_gemini() but yields the answer in pieces as they arrive."""
+        model = self.get_gemini_model(
+            model_to_use, GEMINI_GENERATION_CONFIG, GEMINI_SAFETY_SETTINGS
         )
-        response = model.generate_content(message)
-        self.logger.info(f"   * Gemini responded")
-        # TODO : This needs retry logic.
-        return response.text
+        contents = self.gemini_contents(message, history)
+
+        async def open_stream():
+            response = await model.generate_content_async(contents, stream=True)
+
+            async def pieces():
+                async for chunk in response:
+                    yield chunk.text
+
+            return pieces()
 
-    def get_gemini_models(self) -> list[str]:
+        prompt_tokens = history_tokens(history) + estimate_tokens(message)
+        temperature = GEMINI_GENERATION_CONFIG["temperature"]
+        key = self.cache_key(use_cache and not history, message, model_to_use, temperature)
+        pieces = self.metered_stream(
+            "gemini", model_to_use,
+            self.stream_with_retry(
+                "gemini", model_to_use, open_stream, prompt_tokens + COMPLETION_TOKEN_RESERVE
+            ),
+            prompt_tokens, user_id, chat_id,
+        )
+        async with contextlib.aclosing(self.cached_stream(key, pieces)) as stream:
+            async for piece in stream:
+                yield piece
+
+    async def get_gemini_models(self) -> list[str]:
         # gets the models from Gemini API if you decide to use something new.
-        genai.configure(api_key=self.config.GEMINI_KEY)
-        models = genai.list_models()
+        # The SDK only offers a blocking listing call, so keep it off the event loop.
+        models = await asyncio.to_thread(lambda: list(genai.list_models()))
         outlist= []
         for model in models:
             outlist.append(str(model.name).split("/")[1])
         return(outlist)
-            
\ No newline at end of file
@@ -0,0 +1,102 @@
+# Downloads generated images into the images directory without blocking the bot.
+import asyncio
+import logging
+import os
+
+import aiohttp
+
+# DALL-E images are 2-4 MB; anything far beyond that is not an image we asked for.
+MAX_IMAGE_BYTES = 20 * 1024 * 1024
+CHUNK_SIZE = 64 * 1024
+DOWNLOAD_TIMEOUT = 60
+
+
+class ImageTooLarge(Exception):
+    pass
+
+
+class ImageDownloader:
+    """
+    Streams images from a URL into `save_dir` in chunks over a pooled aiohttp session.
+    The file is written to `save_dir`/.tmp and renamed into place once complete, so the
+    image listings never see partial downloads.  The bytes are handed back so they can be
+    sent to Telegram without reading the file.
+    """
+
+    def __init__(
+        self,
+        logger: logging.Logger,
+        save_dir: str,
+        max_bytes: int = MAX_IMAGE_BYTES,
+        chunk_size: int = CHUNK_SIZE,
+    ) -> None:
+        self.logger = logger.getChild("images")
+        self.save_dir = save_dir
+        # Same filesystem as save_dir, so the final rename is atomic.
+        self.tmp_dir = os.path.join(save_dir, ".tmp")
+        self.max_bytes = max_bytes
+        self.chunk_size = chunk_size
+        self.session = None
+
+    def remove_partial_downloads(self) -> int:
+        """Deletes downloads left behind by a crash or restart; call before the bot starts."""
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        removed = 0
+        for directory in (self.tmp_dir, self.save_dir):
+            for entry in os.scandir(directory):
+                if not entry.is_file():
+                    continue
+                # Older versions kept partial files in save_dir as .name.part.
+                if directory == self.tmp_dir or (
+                    entry.name.startswith(".") and entry.name.endswith(".part")
+                ):
+                    try:
+                        os.remove(entry.path)
+                        removed += 1
+                    except OSError as e:
+                        self.logger.error(f"Could not remove partial download {entry.name}: {e}")
+        if removed:
+            self.logger.info(f"Removed {removed} partial downloads")
+        return removed
+
+    def get_session(self) -> aiohttp.ClientSession:
+        # Created lazily so it belongs to the running event loop.
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=10, keepalive_timeout=60),
+                timeout=aiohttp.ClientTimeout(total=DOWNLOAD_TIMEOUT),
+            )
+        return self.session
+
+    async def close(self) -> None:
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+        self.session = None
+
+    async def download(self, url: str, filename: str) -> bytes:
+        final_path = os.path.join(self.save_dir, filename)
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        tmp_path = os.path.join(self.tmp_dir, f"{filename}.part")
+        data = bytearray()
+        async with self.get_session().get(url) as response:
+            response.raise_for_status()
+            if response.content_length and response.content_length > self.max_bytes:
+                raise ImageTooLarge(f"Image is {response.content_length} bytes")
+            f = await asyncio.to_thread(open, tmp_path, "wb")
+            try:
+                async for chunk in response.content.iter_chunked(self.chunk_size):
+                    data += chunk
+                    if len(data) > self.max_bytes:
+                        raise ImageTooLarge(f"Image is over {self.max_bytes} bytes")
+                    await asyncio.to_thread(f.write, chunk)
+                await asyncio.to_thread(f.close)
+                os.replace(tmp_path, final_path)
+            except BaseException:
+                f.close()
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+                raise
+        self.logger.info(f"Downloaded {len(data)} bytes to {filename}")
+        return bytes(data)
@@ -0,0 +1,116 @@
+# Merges the messages of a listened chat into one prompt instead of one LLM call each.
+import asyncio
+from dataclasses import dataclass, field
+import logging
+
+from telegram import Update
+from telegram.ext import ContextTypes
+
+LISTEN_MODES = ["window", "mentions"]
+
+
+@dataclass(slots=True)
+class PendingBatch:
+    messages: list = field(default_factory=list)  # (speaker, text), oldest first
+    # The latest message's update and context; the reply goes to that message.
+    update: Update = None
+    context: ContextTypes.DEFAULT_TYPE = None
+    timer: asyncio.Task = None
+    dropped: int = 0
+
+
+class ListenBatcher:
+    """
+    Collects listened messages per chat and hands them to `respond(update, context, prompt)`
+    as one multi speaker prompt.
+
+    In "window" mode a batch is sent `window` seconds after its first message.  In
+    "mentions" mode messages are only kept as context and the batch is sent when someone
+    mentions or replies to the bot.  Each chat has at most one answer being written and
+    one batch waiting; past `max_queue` messages the oldest waiting ones are dropped.
+    """
+
+    def __init__(
+        self,
+        logger: logging.Logger,
+        respond,
+        window: float = 5.0,
+        mode: str = "window",
+        max_queue: int = 20,
+    ) -> None:
+        self.logger = logger.getChild("listen_batcher")
+        self.respond = respond
+        self.window = window
+        self.mode = mode if mode in LISTEN_MODES else LISTEN_MODES[0]
+        self.max_queue = max_queue
+        self.batches = {}  # chat id -> PendingBatch
+        self.locks = {}  # chat id -> asyncio.Lock, held while an answer is written
+        self.tasks = set()
+
+    def add(
+        self, chat_id: int, speaker: str, text: str, update: Update,
+        context: ContextTypes.DEFAULT_TYPE, mentioned: bool = False,
+    ) -> None:
+        batch = self.batches.get(chat_id)
+        if batch is None:
+            batch = self.batches[chat_id] = PendingBatch()
+        batch.messages.append((speaker, text))
+        batch.update = update
+        batch.context = context
+        if len(batch.messages) > self.max_queue:
+            # Backpressure: the chat is talking faster than we can answer.
+            del batch.messages[0]
+            batch.dropped += 1
+            if batch.dropped == 1:
+                self.logger.warning(f"Chat {chat_id} is busy, dropping its oldest queued messages")
+        if self.mode == "mentions":
+            if mentioned:
+                self.start(chat_id, batch, 0)
+        elif batch.timer is None:
+            self.start(chat_id, batch, self.window)
+
+    def start(self, chat_id: int, batch: PendingBatch, delay: float) -> None:
+        if batch.timer is not None:
+            if delay:
+                return
+            batch.timer.cancel()
+        batch.timer = asyncio.create_task(self.send_later(chat_id, delay))
+        self.tasks.add(batch.timer)
+        batch.timer.add_done_callback(self.tasks.discard)
+
+    async def send_later(self, chat_id: int, delay: float) -> None:
+        await asyncio.sleep(delay)
+        lock = self.locks.setdefault(chat_id, asyncio.Lock())
+        # While the previous answer is still being written, the batch stays open and keeps
+        # collecting messages.
+        async with lock:
+            batch = self.batches.pop(chat_id, None)
+            if batch is None:
+                return
+            if batch.dropped:
+                self.logger.info(f"Chat {chat_id}: {batch.dropped} messages were dropped from the batch")
+            try:
+                await self.respond(batch.update, batch.context, self.build_prompt(batch.messages))
+            except Exception as e:
+                self.logger.error(f"Error answering batched messages for chat {chat_id}: {e}")
+        if chat_id not in self.batches:
+            # Nothing new came in while answering; a batch that comes later makes a new lock.
+            self.locks.pop(chat_id, None)
+
+    @staticmethod
+    def build_prompt(messages: list) -> str:
+        if len(messages) == 1:
+            return messages[0][1]
+        lines = "\n".join(f"{speaker}: {text}" for speaker, text in messages)
+        return (
+            "Several people wrote in a group chat (oldest first):\n"
+            f"{lines}\n"
+            "Reply once to the conversation, addressing people by name where it helps."
+        )
+
+    async def close(self) -> None:
+        for task in list(self.tasks):
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.batches.clear()
+        self.locks.clear()
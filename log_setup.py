@@ -0,0 +1,141 @@
+# Logging for the bot: rotating (optionally gzipped) files, optional JSON lines, and a
+# queue so the event loop never waits on log I/O.
+import contextvars
+import copy
+import gzip
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import shutil
+import sys
+
+TEXT_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+# Turns exc_info into text before a record is queued (see ContextQueueHandler).
+EXCEPTION_FORMATTER = logging.Formatter()
+# Who the current update is for; set once per update and copied onto every record.
+REQUEST_ID = contextvars.ContextVar("request_id", default=None)
+USER_ID = contextvars.ContextVar("user_id", default=None)
+
+
+class ContextFilter(logging.Filter):
+    """
+    Adds request_id and user_id to records.  Attached to the QueueHandler, so it runs on
+    the thread that logged (where the context vars are set), before the record is queued.
+    """
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if not hasattr(record, "request_id"):
+            record.request_id = REQUEST_ID.get()
+        if not hasattr(record, "user_id"):
+            record.user_id = USER_ID.get()
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line; request_id, user_id and latency are included when known."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": self.formatTime(record, "%Y-%m-%dT%H:%M:%S") + f".{int(record.msecs):03d}",
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for field in ("request_id", "user_id", "latency"):
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            # Formatted by ContextQueueHandler before the record was queued.
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class ContextQueueHandler(logging.handlers.QueueHandler):
+    """
+    The stock prepare() merges the traceback into the message and drops exc_info, so the
+    JSON formatter never saw it.  This keeps the message plain and passes the traceback
+    on as exc_text, which both formatters know how to use.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        if record.exc_info and not record.exc_text:
+            record.exc_text = EXCEPTION_FORMATTER.formatException(record.exc_info)
+        # Tracebacks hold frames alive; the text is all the listener needs.
+        record.exc_info = None
+        return record
+
+
+def gzip_rotator(source: str, dest: str) -> None:
+    with open(source, "rb") as src, gzip.open(dest, "wb") as dst:
+        shutil.copyfileobj(src, dst)
+    os.remove(source)
+
+
+class LogSetup:
+    """
+    Puts a QueueHandler on the `name` logger; a QueueListener thread does the writing to
+    a rotating file (and the console when stderr is a terminal, so a service that
+    redirects output to a file doesn't get every line twice).  configure() can be
+    called again later, e.g. once the config file has been read.
+    """
+
+    def __init__(self, name: str, filename: str, level: int = logging.INFO) -> None:
+        self.filename = filename
+        self.logger = logging.getLogger(name)
+        self.logger.setLevel(level)
+        self.queue = queue.SimpleQueue()
+        self.queue_handler = ContextQueueHandler(self.queue)
+        self.queue_handler.addFilter(ContextFilter())
+        self.logger.addHandler(self.queue_handler)
+        self.listener = None
+        self.configure()
+
+    def configure(
+        self,
+        max_bytes: int = 10 * 1024 * 1024,
+        backups: int = 5,
+        compress: bool = True,
+        rotate: str = "size",
+        json_lines: bool = False,
+    ) -> None:
+        """`rotate` is "size" (at max_bytes) or "daily" (at midnight)."""
+        if rotate == "daily":
+            file_handler = logging.handlers.TimedRotatingFileHandler(
+                self.filename, when="midnight", backupCount=backups, encoding="utf-8"
+            )
+        else:
+            file_handler = logging.handlers.RotatingFileHandler(
+                self.filename, maxBytes=max_bytes, backupCount=backups, encoding="utf-8"
+            )
+        if compress:
+            file_handler.namer = lambda name: name + ".gz"
+            file_handler.rotator = gzip_rotator
+        handlers = [file_handler]
+        if sys.stderr.isatty():
+            handlers.append(logging.StreamHandler())
+        formatter = JsonFormatter() if json_lines else logging.Formatter(TEXT_FORMAT)
+        for handler in handlers:
+            handler.setFormatter(formatter)
+        self.stop()
+        self.listener = logging.handlers.QueueListener(
+            self.queue, *handlers, respect_handler_level=True
+        )
+        self.listener.start()
+
+    def stop(self) -> None:
+        """Writes out what's queued and closes the handlers."""
+        if self.listener is None:
+            return
+        self.listener.stop()
+        for handler in self.listener.handlers:
+            handler.close()
+        self.listener = None
@@ -0,0 +1,135 @@
+# Reads the bot's log from the end, for /log, without loading the whole file.
+from datetime import datetime, timedelta
+import json
+import logging
+import os
+import re
+
+BLOCK_SIZE = 64 * 1024
+# "2024-06-01 10:00:00,123 - tgram.gpt - INFO - message", see the formatter in tgram_main.
+LOG_LINE = re.compile(
+    r"^(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}),\d+ - [^ ]+ - ([A-Z]+) - "
+)
+RELATIVE_TIME = re.compile(r"^(\d+)([smhd])$")
+TIME_UNITS = {"s": "seconds", "m": "minutes", "h": "hours", "d": "days"}
+LEVELS = {
+    "DEBUG": logging.DEBUG,
+    "INFO": logging.INFO,
+    "WARNING": logging.WARNING,
+    "ERROR": logging.ERROR,
+    "CRITICAL": logging.CRITICAL,
+}
+
+
+def reverse_lines(filename: str, block_size: int = BLOCK_SIZE):
+    """Yields the lines of a file last to first, reading fixed size blocks from the end."""
+    with open(filename, "rb") as f:
+        position = f.seek(0, os.SEEK_END)
+        tail = b""
+        while position > 0:
+            step = min(block_size, position)
+            position -= step
+            f.seek(position)
+            block = f.read(step) + tail
+            lines = block.split(b"\n")
+            # The first piece may be the end of a line that starts in an earlier block.
+            tail = lines.pop(0)
+            for line in reversed(lines):
+                if line:
+                    yield line.decode("utf-8", "replace")
+        if tail:
+            yield tail.decode("utf-8", "replace")
+
+
+def parse_header(line: str) -> tuple[datetime, int] | None:
+    """(time, level number) of a log record's first line, None for continuation lines."""
+    if line.startswith("{"):
+        # logformat=json
+        try:
+            entry = json.loads(line)
+            return datetime.fromisoformat(entry["time"]), LEVELS.get(entry["level"], 0)
+        except (ValueError, KeyError, TypeError):
+            return None
+    match = LOG_LINE.match(line)
+    if match is None:
+        return None
+    try:
+        when = datetime.strptime(match.group(1), "%Y-%m-%d %H:%M:%S")
+    except ValueError:
+        return None
+    return when, LEVELS.get(match.group(2), 0)
+
+
+def parse_time(value: str, now: datetime = None) -> datetime | None:
+    """Accepts relative times (30m, 2h, 1d) or dates (2024-06-01, 2024-06-01T10:00)."""
+    match = RELATIVE_TIME.match(value.strip().lower())
+    if match:
+        amount, unit = match.groups()
+        return (now or datetime.now()) - timedelta(**{TIME_UNITS[unit]: int(amount)})
+    try:
+        return datetime.fromisoformat(value.strip())
+    except ValueError:
+        return None
+
+
+def parse_args(args: list[str], max_count: int, count: int = 6) -> dict:
+    """
+    /log options (L:#, grep:text, level:name, since:time, until:time) as keyword
+    arguments for tail().  The count is kept between 1 and `max_count`, and anything not
+    understood is ignored.
+    """
+    options = {"count": count, "pattern": None, "min_level": 0, "since": None, "until": None}
+    for arg in args:
+        name, _, value = arg.partition(":")
+        name = name.lower()
+        if name == "l":
+            try:
+                options["count"] = min(max(1, int(value)), max_count)
+            except ValueError:
+                pass
+        elif name == "grep" and value:
+            options["pattern"] = value
+        elif name == "level" and value.upper() in LEVELS:
+            options["min_level"] = LEVELS[value.upper()]
+        elif name in ("since", "until"):
+            options[name] = parse_time(value)
+    return options
+
+
+def tail(
+    filename: str,
+    count: int = 6,
+    pattern: str = None,
+    min_level: int = 0,
+    since: datetime = None,
+    until: datetime = None,
+) -> list[str]:
+    """
+    The last `count` log records (oldest first) matching every given filter: `pattern`
+    (case insensitive text), `min_level` (logging level number) and the `since`/`until`
+    time range.  A record is its first line plus any continuation lines, like tracebacks.
+    Reading stops once records are older than `since`.
+    """
+    pattern = pattern.lower() if pattern else None
+    records = []
+    pending = []  # continuation lines seen (bottom up) before their header
+    for line in reverse_lines(filename):
+        header = parse_header(line)
+        if header is None:
+            pending.append(line)
+            continue
+        when, level = header
+        record = "\n".join([line] + pending[::-1])
+        pending = []
+        if since is not None and when < since:
+            break
+        if until is not None and when > until:
+            continue
+        if level < min_level:
+            continue
+        if pattern and pattern not in record.lower():
+            continue
+        records.append(record)
+        if len(records) >= count:
+            break
+    return records[::-1]
@@ -0,0 +1,180 @@
+# Sends an answer to Telegram while it is still being generated.
+import asyncio
+import logging
+import re
+import time
+
+from telegram import Message
+from telegram.constants import ParseMode
+from telegram.error import BadRequest, RetryAfter
+
+# Telegram's maximum message length.
+MESSAGE_LIMIT = 4096
+# Minimum seconds between edits, Telegram throttles bots that edit faster.
+EDIT_INTERVAL = 1.0
+PLACEHOLDER = "✍️ ..."
+# A tag, an entity, a run of plain text, or a stray < or &.
+HTML_TOKEN = re.compile(r"<[^<>]*>|&#?\w+;|[^<&]+|[<&]")
+TAG_NAME = re.compile(r"</?\s*([a-zA-Z0-9-]+)")
+
+
+def tag_of(token: str) -> tuple[str, bool]:
+    """(lower case tag name, is an opening tag), or ("", False) for text and entities."""
+    match = TAG_NAME.match(token) if len(token) > 1 else None
+    if not match:
+        return "", False
+    return match.group(1).lower(), not token.startswith("</") and not token.endswith("/>")
+
+
+def track_tag(open_tags: list, token: str) -> None:
+    """Pushes an opening tag onto `open_tags`, or pops the innermost match of a closing one."""
+    name, opening = tag_of(token)
+    if opening:
+        open_tags.append((name, token))
+        return
+    for i in range(len(open_tags) - 1, -1, -1):
+        if name and open_tags[i][0] == name:
+            del open_tags[i]
+            return
+
+
+def split_html(text: str, limit: int = MESSAGE_LIMIT) -> list[str]:
+    """
+    Splits HTML into pieces of at most `limit` characters without cutting a tag or an
+    entity in half.  Tags still open at a split are closed at the end of the piece and
+    opened again at the start of the next one, so every piece parses on its own.
+    """
+    chunks = []
+    current = ""
+    open_tags = []  # (name, opening tag as written)
+
+    def closing() -> str:
+        return "".join(f"</{name}>" for name, _ in reversed(open_tags))
+
+    for token in HTML_TOKEN.findall(text):
+        name, opening = tag_of(token)
+        atomic = bool(name) or (token.startswith("&") and token.endswith(";"))
+        # An opening tag needs room for its closing tag too, and a closing tag already
+        # has its room kept by closing().
+        needed = len(token) + len(name) + 3 if opening else 0 if name else len(token)
+        rest = token
+        while rest:
+            room = limit - len(current) - len(closing())
+            piece = (rest if needed <= room else "") if atomic else rest[:room]
+            reopening = "".join(tag for _, tag in open_tags)
+            if not piece and current != reopening:
+                chunks.append(current + closing())
+                current = reopening
+                continue
+            # Only a limit smaller than the markup itself gets here: a tag or entity goes in
+            # whole, text one character at a time, rather than looping forever.
+            piece = piece or (rest if atomic else rest[:max(1, room)])
+            current += piece
+            rest = rest[len(piece):]
+        track_tag(open_tags, token)
+    if current or not chunks:
+        chunks.append(current + closing())
+    return chunks
+
+
+class ProgressiveReply:
+    """
+    Replies to `reply_to` with a placeholder and keeps editing it as text comes in.
+    Edits are batched to at most one per EDIT_INTERVAL, and text past the 4096
+    character limit spills into extra messages.
+    """
+
+    def __init__(
+        self,
+        reply_to: Message,
+        logger: logging.Logger,
+        parse_mode: str = None,
+        edit_interval: float = EDIT_INTERVAL,
+    ) -> None:
+        self.reply_to = reply_to
+        self.logger = logger
+        self.parse_mode = parse_mode
+        self.edit_interval = edit_interval
+        self.text = ""
+        self.messages = []  # sent telegram messages, in order
+        self.shown = []  # text currently displayed by each message
+        self.next_edit = 0.0
+
+    async def start(self) -> None:
+        message = await self.reply_to.reply_text(text=PLACEHOLDER)
+        self.messages.append(message)
+        self.shown.append(PLACEHOLDER)
+
+    async def push(self, piece: str) -> None:
+        self.text += piece
+        if time.monotonic() >= self.next_edit:
+            await self.render()
+
+    async def replace(self, text: str) -> None:
+        self.text = text
+        await self.render()
+
+    async def finish(self, text: str = None) -> str:
+        if text is not None:
+            self.text = text
+        # The final text has to land, so wait out any flood control.
+        while not await self.render(final=True):
+            await asyncio.sleep(max(0.0, self.next_edit - time.monotonic()))
+        return self.text
+
+    async def discard(self) -> None:
+        """Removes the placeholder if nothing was written into it."""
+        if self.text or not self.messages:
+            return
+        try:
+            await self.messages[0].delete()
+        except Exception as e:
+            self.logger.error(f"Could not remove placeholder message: {e}")
+        self.messages.clear()
+        self.shown.clear()
+
+    async def render(self, final: bool = False) -> bool:
+        """Shows the current text.  False if Telegram asked us to wait (see next_edit)."""
+        if not self.messages:
+            await self.start()
+        try:
+            await self.show(self.chunks(final))
+        except RetryAfter as e:
+            self.logger.warning(f"Telegram asked to slow down edits for {e.retry_after}s")
+            self.next_edit = time.monotonic() + e.retry_after
+            return False
+        except BadRequest as e:
+            if "not modified" not in str(e).lower():
+                raise
+        self.next_edit = time.monotonic() + self.edit_interval
+        return True
+
+    def chunks(self, final: bool) -> list[str]:
+        """The text split at the message limit, with a typing marker until it's final."""
+        if self.parse_mode == ParseMode.HTML and self.text:
+            # Room for the marker is kept so it never pushes a piece over the limit.
+            chunks = split_html(self.text, MESSAGE_LIMIT - 2)
+            return chunks if final else chunks[:-1] + [chunks[-1] + " ▌"]
+        chunks = [
+            self.text[i: i + MESSAGE_LIMIT] for i in range(0, len(self.text), MESSAGE_LIMIT)
+        ] or [PLACEHOLDER]
+        if not final and self.text and len(chunks[-1]) < MESSAGE_LIMIT:
+            # Let the reader know more is coming.
+            chunks[-1] = chunks[-1][: MESSAGE_LIMIT - 2] + " ▌"
+        return chunks
+
+    async def show(self, chunks: list[str]) -> None:
+        """Edits the sent messages to match `chunks`, sending or deleting messages as needed."""
+        for i, chunk in enumerate(chunks):
+            if i < len(self.messages):
+                if self.shown[i] != chunk:
+                    await self.messages[i].edit_text(text=chunk, parse_mode=self.parse_mode)
+                    self.shown[i] = chunk
+            else:
+                message = await self.messages[-1].reply_text(text=chunk, parse_mode=self.parse_mode)
+                self.messages.append(message)
+                self.shown.append(chunk)
+        # The text can shrink after replace(); drop messages that are no longer needed.
+        while len(self.messages) > len(chunks):
+            await self.messages.pop().delete()
+            self.shown.pop()
@@ -0,0 +1,87 @@
+# Quotes for /q, loaded once and indexed so picking one doesn't touch the disk.
+from array import array
+from bisect import bisect_right
+import logging
+import random
+import re
+
+WORD = re.compile(r"[\w']{3,}")
+
+
+class QuoteStore:
+    """
+    Holds the bytes of every quote file (one quote per line) with an index of where each
+    line starts and ends, so a random quote is picked in O(1).  A keyword index
+    (word -> quote numbers) is built at load time for /q <word>.  Call load() again when
+    a file changes.
+
+    The files are read into memory rather than memory-mapped: they're small, and a mapped
+    file that gets truncated while someone edits it would crash the bot on the next read.
+    """
+
+    def __init__(self, logger: logging.Logger, filenames: list[str]) -> None:
+        self.logger = logger.getChild("quotes")
+        self.filenames = filenames
+        self.data = []  # per file: bytes
+        self.starts = []  # per file: array of line start offsets
+        self.ends = []  # per file: array of line end offsets
+        self.first_ids = []  # per file: number of the file's first quote
+        self.count = 0
+        self.keywords = {}  # word -> array of quote numbers
+
+    def load(self) -> None:
+        data, starts, ends, first_ids, keywords = [], [], [], [], {}
+        count = 0
+        for filename in self.filenames:
+            try:
+                with open(filename, "rb") as f:
+                    raw = f.read()
+            except OSError as e:
+                self.logger.error(f"Could not read quote file '{filename}': {e}")
+                continue
+            file_starts, file_ends = array("L"), array("L")
+            first_ids.append(count)
+            position = 0
+            while position < len(raw):
+                end = raw.find(b"\n", position)
+                if end == -1:
+                    end = len(raw)
+                line = raw[position:end].strip()
+                if line:
+                    file_starts.append(position)
+                    file_ends.append(end)
+                    for word in set(WORD.findall(line.decode("utf-8", "replace").casefold())):
+                        keywords.setdefault(word, array("L")).append(count)
+                    count += 1
+                position = end + 1
+            data.append(raw)
+            starts.append(file_starts)
+            ends.append(file_ends)
+        # Swap everything in at once so /q never sees a half built index.
+        self.data, self.starts, self.ends = data, starts, ends
+        self.first_ids, self.keywords, self.count = first_ids, keywords, count
+        self.logger.info(f"Loaded {count} quotes from {len(data)} files")
+
+    def quote(self, number: int) -> str:
+        file_index = bisect_right(self.first_ids, number) - 1
+        line = number - self.first_ids[file_index]
+        raw = self.data[file_index][self.starts[file_index][line]: self.ends[file_index][line]]
+        return raw.decode("utf-8", "replace").strip()
+
+    def random_quote(self, keywords: str = "") -> str | None:
+        """A random quote, containing every word of `keywords` if given.  None if none match."""
+        words = WORD.findall(keywords.casefold())
+        if not words:
+            if not self.count:
+                return None
+            return self.quote(random.randrange(self.count))
+        matches = None
+        # Start from the rarest word so the intersection stays small.
+        for word in sorted(words, key=lambda w: len(self.keywords.get(w, ()))):
+            found = self.keywords.get(word)
+            if not found:
+                return None
+            matches = set(found) if matches is None else matches.intersection(found)
+            if not matches:
+                return None
+        return self.quote(random.choice(tuple(matches)))
@@ -0,0 +1,112 @@
+# Cache of LLM answers for prompts that are asked over and over.
+from collections import OrderedDict
+import hashlib
+import json
+import logging
+import os
+import time
+
+from file_utils import atomic_write
+
+
+class ResponseCache:
+    """
+    LRU cache of answers with a time to live.  Bounded by entry count and by the total
+    size of the cached text.  Can be saved to and loaded from a JSON file.
+    """
+
+    def __init__(
+        self,
+        logger: logging.Logger,
+        max_entries: int = 512,
+        ttl: int = 3600,
+        max_bytes: int = 8 * 1024 * 1024,
+        filename: str = None,
+    ) -> None:
+        self.logger = logger.getChild("response_cache")
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.filename = filename
+        self.entries = OrderedDict()  # key -> (expires at, text)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        if self.filename:
+            self.load()
+
+    @staticmethod
+    def make_key(prompt: str, model: str, temperature, system_prompt: str = "") -> str:
+        normalized = " ".join(prompt.split()).casefold()
+        raw = json.dumps([normalized, model, temperature, system_prompt])
+        return hashlib.sha256(raw.encode()).hexdigest()
+
+    def get(self, key: str) -> str | None:
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires, text = entry
+        if expires < time.time():
+            self.remove(key)
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return text
+
+    def put(self, key: str, text: str, expires: float = None) -> None:
+        """`expires` (a timestamp) defaults to ttl seconds from now."""
+        if not text or len(text) > self.max_bytes:
+            return
+        if key in self.entries:
+            self.remove(key)
+        self.entries[key] = (expires if expires is not None else time.time() + self.ttl, text)
+        self.size += len(text)
+        while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+            oldest = next(iter(self.entries))
+            self.remove(oldest)
+
+    def remove(self, key: str) -> None:
+        _, text = self.entries.pop(key)
+        self.size -= len(text)
+
+    def clear(self) -> None:
+        self.entries.clear()
+        self.size = 0
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "bytes": self.size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+        }
+
+    def save(self) -> None:
+        if not self.filename:
+            return
+        now = time.time()
+        live = [[k, e, t] for k, (e, t) in self.entries.items() if e >= now]
+        try:
+            atomic_write(self.filename, json.dumps(live))
+            self.logger.info(f"Saved {len(live)} cached responses to {self.filename}")
+        except Exception as e:
+            self.logger.error(f"Error saving response cache: {e}")
+
+    def load(self) -> None:
+        if not os.path.exists(self.filename):
+            return
+        try:
+            with open(self.filename, "r") as f:
+                saved = json.load(f)
+        except Exception as e:
+            self.logger.error(f"Error loading response cache: {e}")
+            return
+        now = time.time()
+        for key, expires, text in saved:
+            if expires >= now:
+                self.put(key, text, expires)
+        self.logger.info(f"Loaded {len(self.entries)} cached responses")
@@ -0,0 +1,273 @@
+# CPU, memory and disk use of the host and of the bot process itself, for /cpu, /mem,
+# /disk and /sys.  The /proc files are read in one pass each.
+import asyncio
+from collections import deque
+from dataclasses import dataclass
+import logging
+import os
+import time
+
+SPARK_BARS = "▁▂▃▄▅▆▇█"
+HISTORY_MINUTES = (1, 5, 15)
+
+
+def format_data_into_size(number: str) -> list:
+    """
+    The function `format_data_into_size` takes a number as a string input and returns a list containing
+    the long and short format of the data size based on the number of commas in the input.
+
+    :param number: The function `format_data_into_size` takes a string input `number` and converts it
+    into a list containing the long and short format of the data size based on the number of commas
+    present in the input string
+    :type number: str
+    :return: The function `format_data_into_size` is returning a list containing the long and short
+    format of the data size based on the number of commas in the input string `number`.
+    """
+    data_long = {
+        "0": "Bytes",
+        "1": "KiloBytes",
+        "2": "MegaBytes",
+        "3": "GigaBytes",
+        "4": "TeraBytes",
+    }
+    data_short = {
+        "0": "B",
+        "1": "KB",
+        "2": "MB",
+        "3": "GB",
+        "4": "TB",
+    }
+    return [data_long[str(number.count(","))], data_short[str(number.count(","))]]
+
+
+def format_data_into_str(number: int) -> list:
+    """
+    The function `format_data_into_str` takes an integer, formats it with commas, calculates the number
+    of commas, and returns a list with the formatted number and its size in a shorthand format.
+
+    :param number: The function `format_data_into_str` takes an integer `number` as input and formats it
+    into a list of two strings. The first string in the list represents the number in a shortened format
+    with the appropriate size indicator, and the second string represents the number in a similar format
+    but with a different
+    :type number: int
+    :return: The function `format_data_into_str` returns a list containing two formatted strings. The
+    first string is the input number formatted with commas and a size indicator, while the second string
+    is a shorthand version of the input number with a decimal point and a size indicator.
+    """
+    num_as_str = "{:,}".format(number)
+    commas = num_as_str.count(",")
+    if commas == 0:
+        return [
+            num_as_str + " " + format_data_into_size(num_as_str)[0],
+            num_as_str + " " + format_data_into_size(num_as_str)[1],
+        ]
+    shorthand_num = num_as_str.split(",")[0] + "." + num_as_str.split(",")[1][0:2]
+    type_list = format_data_into_size(num_as_str)
+    return [shorthand_num + " " + type_list[0], shorthand_num + " " + type_list[1]]
+
+
+def read_cpu_times() -> list[tuple[float, float]]:
+    """(total, idle) jiffies from /proc/stat, the combined "cpu" line first, then one per CPU."""
+    cpu_times = []
+    with open("/proc/stat", "r") as f:
+        for line in f:
+            if not line.startswith("cpu"):
+                # The cpu lines come first, nothing after them is needed.
+                break
+            fields = [float(column) for column in line.split()[1:]]
+            # idle time is the fourth column in /proc/stat
+            cpu_times.append((sum(fields), fields[3]))
+    return cpu_times
+
+
+def read_proc_fields(filename: str) -> dict:
+    """
+    "Name:  value [kB]" files (/proc/meminfo, /proc/self/status) as {name: int}, kB values
+    in bytes.  Fields that aren't numbers are skipped.
+    """
+    values = {}
+    with open(filename, "r") as f:
+        for line in f:
+            name, _, value = line.partition(":")
+            parts = value.split()
+            if parts and parts[0].isdigit():
+                values[name] = int(parts[0]) * (1024 if parts[-1] == "kB" else 1)
+    return values
+
+
+def read_meminfo() -> dict:
+    return read_proc_fields("/proc/meminfo")
+
+
+def memory_used(meminfo: dict) -> int:
+    return meminfo.get("MemTotal", 0) - (
+        meminfo.get("MemFree", 0) + meminfo.get("Buffers", 0)
+        + meminfo.get("Cached", 0) + meminfo.get("SReclaimable", 0)
+    )
+
+
+def disk_space(path: str = "/") -> tuple[int, int, int]:
+    """(total, used, free) bytes of the filesystem holding `path`."""
+    statvfs = os.statvfs(path)
+    total = statvfs.f_blocks * statvfs.f_frsize
+    used = (statvfs.f_blocks - statvfs.f_bfree) * statvfs.f_frsize
+    return total, used, statvfs.f_bavail * statvfs.f_frsize
+
+
+def count_open_fds() -> int:
+    return len(os.listdir("/proc/self/fd"))
+
+
+def get_memory_usage() -> str:
+    meminfo = read_meminfo()
+    return (
+        f"total: {format_data_into_str(meminfo.get('MemTotal', 0))[1]}"
+        f" | used: {format_data_into_str(memory_used(meminfo))[1]}"
+        f" | free: {format_data_into_str(meminfo.get('MemAvailable', 0))[1]}"
+    )
+
+
+def get_disk_usage(path: str = "/") -> str:
+    total, used, free = disk_space(path)
+    return (
+        f"total: {format_data_into_str(total)[1]} | used: {format_data_into_str(used)[1]}"
+        f" | free: {format_data_into_str(free)[1]}"
+    )
+
+
+@dataclass(slots=True)
+class Sample:
+    time: float
+    cpu: list  # percent busy, the whole machine first, then one per CPU
+    mem_total: int
+    mem_used: int
+    mem_available: int
+    disk_total: int
+    disk_used: int
+    disk_free: int
+    # The bot process: resident memory, open file descriptors, threads, and how late the
+    # sampler woke up (seconds), which is how long something held up the event loop.
+    rss: int = 0
+    fds: int = 0
+    threads: int = 0
+    loop_lag: float = 0.0
+
+    @property
+    def mem_percent(self) -> float:
+        return 100 * self.mem_used / self.mem_total if self.mem_total else 0.0
+
+    @property
+    def disk_percent(self) -> float:
+        return 100 * self.disk_used / self.disk_total if self.disk_total else 0.0
+
+
+class SystemSampler:
+    """
+    Takes a sample every `interval` seconds in a background task (run()) and keeps the
+    last `history` seconds of them in a ring buffer, so /cpu and /sys answer right away.
+    CPU use is the difference between two /proc/stat readings, one interval apart.
+    """
+
+    def __init__(
+        self,
+        logger: logging.Logger,
+        interval: float = 5,
+        history: float = 15 * 60,
+        disk_path: str = "/",
+    ) -> None:
+        self.logger = logger.getChild("system_metrics")
+        self.interval = interval
+        self.disk_path = disk_path
+        self.samples = deque(maxlen=int(history // interval) + 1)
+        self.last_times = None
+        self.loop_lag = 0.0
+
+    def sample(self) -> Sample | None:
+        """Reads everything once and adds a sample; None on the first call (no CPU delta yet)."""
+        cpu_times = read_cpu_times()
+        previous, self.last_times = self.last_times, cpu_times
+        if previous is None:
+            return None
+        cpu = []
+        for (prev_total, prev_idle), (cur_total, cur_idle) in zip(previous, cpu_times):
+            total_diff = cur_total - prev_total
+            idle_diff = cur_idle - prev_idle
+            cpu.append(100 * (1 - idle_diff / total_diff) if total_diff > 0 else 0.0)
+        meminfo = read_meminfo()
+        status = read_proc_fields("/proc/self/status")
+        sample = Sample(
+            time.time(), cpu, meminfo.get("MemTotal", 0), memory_used(meminfo),
+            meminfo.get("MemAvailable", 0), *disk_space(self.disk_path),
+            rss=status.get("VmRSS", 0), fds=count_open_fds(),
+            threads=status.get("Threads", 0), loop_lag=self.loop_lag,
+        )
+        self.samples.append(sample)
+        return sample
+
+    async def run(self) -> None:
+        # Background task, started in startup_services.
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                self.sample()
+            except Exception as e:
+                self.logger.error(f"Error sampling system metrics: {e}")
+            wake_at = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            self.loop_lag = max(0.0, loop.time() - wake_at)
+            if self.loop_lag > 1:
+                self.logger.warning(f"Event loop was blocked for {self.loop_lag:.2f}s")
+
+    def latest(self) -> Sample | None:
+        return self.samples[-1] if self.samples else None
+
+    def recent(self, seconds: float) -> list[Sample]:
+        """Samples from the last `seconds`, oldest first."""
+        since = time.time() - seconds
+        found = []
+        for sample in reversed(self.samples):
+            if sample.time < since:
+                break
+            found.append(sample)
+        return found[::-1]
+
+    def averages(self, field: str = "cpu") -> dict:
+        """{minutes: average} over the last 1, 5 and 15 minutes ("cpu" is the whole machine)."""
+        result = {}
+        for minutes in HISTORY_MINUTES:
+            values = self.values(field, minutes * 60)
+            result[minutes] = sum(values) / len(values) if values else None
+        return result
+
+    def values(self, field: str, seconds: float) -> list[float]:
+        if field == "cpu":
+            return [sample.cpu[0] for sample in self.recent(seconds)]
+        return [getattr(sample, field) for sample in self.recent(seconds)]
+
+    def sparkline(self, field: str = "cpu", seconds: float = 15 * 60, width: int = 30) -> str:
+        """Percentages over time as bars, averaged down to at most `width` characters."""
+        values = self.values(field, seconds)
+        if not values:
+            return ""
+        step = max(1, -(-len(values) // width))
+        bars = []
+        for i in range(0, len(values), step):
+            chunk = values[i: i + step]
+            level = min(max(sum(chunk) / len(chunk), 0), 100)
+            bars.append(SPARK_BARS[min(int(level / 100 * len(SPARK_BARS)), len(SPARK_BARS) - 1)])
+        return "".join(bars)
+
+    @staticmethod
+    def process_text(sample: Sample) -> str:
+        return (
+            f"rss: {format_data_into_str(sample.rss)[1]} | fds: {sample.fds}"
+            f" | threads: {sample.threads} | loop lag: {sample.loop_lag * 1000:.0f} ms"
+        )
+
+    def history_text(self, field: str = "cpu") -> str:
+        """"1m 12.3% | 5m 10.1% | 15m 9.8%" followed by the 15 minute sparkline."""
+        averages = " | ".join(
+            f"{minutes}m {value:.1f}%" if value is not None else f"{minutes}m -"
+            for minutes, value in self.averages(field).items()
+        )
+        return f"{averages}\n{self.sparkline(field)}"
@@ -1,32 +1,47 @@
 import asyncio
+import contextlib
 from enum import Enum
 from functools import wraps
+import html
 import json
 import re
 import subprocess
-import requests
 from telegram.ext import (
     ApplicationBuilder,
     ContextTypes,
     CommandHandler,
     filters,
     MessageHandler,
+    TypeHandler,
 )
 from telegram import (
     InputMediaPhoto,
+    Message,
     Update,
     constants,
 )
-import logging
 import random
 import os
 import time
 import allowlist
+import log_tools
+from log_setup import LogSetup, REQUEST_ID, USER_ID
 import string
 import chat_properties
-from app_config import BotConfiguration
+from app_config import BotConfiguration, SETTINGS
 from user_state import UserStates
+from user_store import UserStore
 from gpt import LLM_ACCESS
+from conversation import ConversationStore
+from config_watcher import ConfigWatcher
+from listen_batcher import ListenBatcher
+from transcript import TranscriptWriter
+from quotes import QuoteStore
+from progressive_reply import ProgressiveReply
+from response_cache import ResponseCache
+from usage import UsageTracker
+from system_metrics import SystemSampler, format_data_into_str, get_disk_usage, get_memory_usage
+from image_store import ImageDownloader
 
 
 
@@ -37,33 +52,106 @@ TELEGRAM_BOT_SERVICE_NAME = "tgram.service"
 # Logger config
 LOGGER_NAME = "tgram"
 LOGGER_FILE_NAME = "tgram_log.txt"
-logger = logging.getLogger(LOGGER_NAME)
-logger.setLevel(logging.INFO)
-console_handler = logging.StreamHandler()
-console_handler.setLevel(logging.INFO)
-formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
-console_handler.setFormatter(formatter)
-logger.addHandler(console_handler)
-logging_file_handler = logging.FileHandler(LOGGER_FILE_NAME)
-logging_file_handler.setLevel(logging.INFO)
-logging_file_handler.setFormatter(formatter)
-logger.addHandler(logging_file_handler)
+LOGS = LogSetup(LOGGER_NAME, LOGGER_FILE_NAME)
+logger = LOGS.logger
 
 # Load config
 # TODO : Make this the global configurationer
 APP_CONFIG = BotConfiguration("keys.txt", logger)
 
+
+def configure_logging():
+    LOGS.configure(
+        max_bytes=APP_CONFIG.LOG_MAX_BYTES,
+        backups=APP_CONFIG.LOG_BACKUPS,
+        compress=APP_CONFIG.LOG_COMPRESS,
+        rotate=APP_CONFIG.LOG_ROTATE,
+        json_lines=APP_CONFIG.LOG_FORMAT == "json",
+    )
+
+
+configure_logging()
+
+# Cache for repeated context free prompts (optional)
+RESPONSE_CACHE = None
+if APP_CONFIG.RESPONSE_CACHE:
+    RESPONSE_CACHE = ResponseCache(
+        logger,
+        max_entries=APP_CONFIG.RESPONSE_CACHE_SIZE,
+        ttl=APP_CONFIG.RESPONSE_CACHE_TTL,
+        filename=None if APP_CONFIG.RESPONSE_CACHE_FILE == "none" else APP_CONFIG.RESPONSE_CACHE_FILE,
+    )
+
+# Token and cost accounting, saved to a JSON file unless turned off
+USAGE = UsageTracker(
+    logger,
+    filename=None if APP_CONFIG.USAGE_FILE == "none" else APP_CONFIG.USAGE_FILE,
+    prices=APP_CONFIG.MODEL_PRICES,
+)
+
 # LLM class
-LLM = LLM_ACCESS(APP_CONFIG, logger)
+LLM = LLM_ACCESS(APP_CONFIG, logger, cache=RESPONSE_CACHE, usage=USAGE)
+
+# Transcript of prompts and answers (CHAT_FILE), written in the background
+TRANSCRIPT = TranscriptWriter(
+    logger,
+    APP_CONFIG.CHAT_FILE,
+    max_bytes=APP_CONFIG.TRANSCRIPT_MAX_BYTES,
+    backups=APP_CONFIG.TRANSCRIPT_BACKUPS,
+    compress=APP_CONFIG.TRANSCRIPT_COMPRESS,
+)
+
+# Downloads generated images into ./images
+IMAGES = ImageDownloader(logger, os.path.join(os.getcwd(), "images"))
+IMAGES.remove_partial_downloads()
 
 # Create the allowlist
 allow_list = allowlist.AllowList(APP_CONFIG.ALLOW_LIST_FILENAME)
 
-# User states
-users = UserStates(logger)
+# User states (saved to SQLite, loaded per user on first use)
+USER_STORE = UserStore(APP_CONFIG.USER_STATE_DB, logger)
+users = UserStates(
+    logger,
+    store=USER_STORE,
+    idle_ttl=APP_CONFIG.USER_STATE_IDLE_TTL,
+    max_resident=APP_CONFIG.USER_STATE_MAX_RESIDENT,
+)
+users.load_users()
+
+# Recent exchanges per user and chat, sent along with new prompts (saved with the users)
+CONVERSATIONS = ConversationStore(
+    logger,
+    max_turns=APP_CONFIG.HISTORY_TURNS,
+    summary_tokens=APP_CONFIG.HISTORY_SUMMARY_TOKENS,
+    store=USER_STORE,
+)
+
+# Quotes for /q from one or more files (quotefile=a.txt, b.txt), reloaded when they change
+QUOTES = QuoteStore(logger, APP_CONFIG.quote_files())
+QUOTES.load()
+
+# Picks up edits to keys.txt and the allow list (see reload_config / reload_allow_list)
+CONFIG_WATCHER = ConfigWatcher(logger, interval=APP_CONFIG.RELOAD_INTERVAL)
+# Settings that are only read at startup, a reload just warns about them.
+RESTART_ONLY_SETTINGS = {
+    "BOT_KEY", "ADMIN", "USER_STATE_DB", "USER_STATE_FLUSH", "RESPONSE_CACHE",
+    "RESPONSE_CACHE_SIZE", "RESPONSE_CACHE_TTL", "RESPONSE_CACHE_FILE", "USAGE_FILE",
+    "USAGE_FLUSH", "RELOAD_INTERVAL", "CHAT_PROPERTIES_FILE", "CHAT_FILE",
+    "METRICS_INTERVAL", "CONCURRENT_UPDATES",
+}
+RATE_LIMIT_SETTINGS = {
+    "OPENAI_MAX_CONCURRENT", "OPENAI_RPM", "OPENAI_TPM", "GEMINI_MAX_CONCURRENT",
+    "GEMINI_RPM", "GEMINI_TPM", "MODEL_LIMITS",
+}
+
+# Host and bot process metrics for /cpu, /mem and /sys, sampled in the background
+SYSTEM = SystemSampler(logger, interval=APP_CONFIG.METRICS_INTERVAL)
+
+# Tasks started in startup_services and stopped in shutdown_services
+BACKGROUND_TASKS = []
 
 # Chat properties (to allow reading of text freely)
-CHAT_PROPS = chat_properties.ChatProperties(logger)
+CHAT_PROPS = chat_properties.ChatProperties(logger, filename=APP_CONFIG.CHAT_PROPERTIES_FILE)
 
 
 class HelpText:
@@ -79,9 +167,11 @@ class HelpText:
             "/g": "send to Google Gemini",
             "long/g": "Send to Google Gemini all text after this message.  After that, a response will be returned.  This can take a few seconds to generate.  This uses Google Gemini.  WARNING ** Content filters are set low **",
             "/cross": "Cross check Gemini against ChatGPT",
-            "long/cross": "Cross check a message that is first checked against gemini then against ChatGPT.",
+            "long/cross": "Cross check a message that is sent to Gemini and ChatGPT at the same time, then refined by ChatGPT.  Add <code>fast:y</code> to see the first answer right away while the refined one is on its way.",
             "/p": "create me a picture (1024x1024 default)",
             "long/p": "create a picture from a text description.  All text included will create a picture for you.  This is a picture in 1024x1024 format. Other valid arguments are `size:h` and `size:v` for horizontal or verticle.  Also quality can be Standard (default) or HD by `q:hd`.",
+            "/forget": "Forget our conversation so far",
+            "long/forget": "Clears the earlier messages the bot remembers from you in this chat.  Your next /c or /g starts a fresh conversation.",
             "/aboutme": "Tell us things about you",
             "long/aboutme": "Tells things about your telegram account, and if you have a subject stored.",
             "/help": "<i>command without slash</i> (ex: <code>/help aboutme</code>)",
@@ -89,7 +179,7 @@ class HelpText:
             "/feedback": "Provide feedback on the bot.",
             "long/feedback": "Provide feedback to the developer about this bot and how it is working, feature improvements or something else?",
             "/q": "random quote",
-            "long/q": "random quote",
+            "long/q": "random quote.  Add words to get a quote that has all of them, ex: <code>/q life love</code>",
             "/listmyimages": "Lists all your images you have created under your account and this bot (if they exist still)",
             "long/listmyimages": "Usage <code>/listmyimages</code> will list all the images you have created with this account if they exist.",
             "/getmyimage": "Get the image by filename",
@@ -185,7 +275,7 @@ def create_random_filename(size: int) -> str:
 
 def user_allowed(id) -> bool:
     if APP_CONFIG.USE_ALLOW_LIST:
-        if id in allow_list.id_list:
+        if allow_list.user_exists(id):
             return True
         else:
             return False
@@ -208,176 +298,6 @@ def is_user_allowed(func):
     return wrapper
 
 
-def format_data_into_size(number: str) -> list:
-    """
-    The function `format_data_into_size` takes a number as a string input and returns a list containing
-    the long and short format of the data size based on the number of commas in the input.
-
-    :param number: The function `format_data_into_size` takes a string input `number` and converts it
-    into a list containing the long and short format of the data size based on the number of commas
-    present in the input string
-    :type number: str
-    :return: The function `format_data_into_size` is returning a list containing the long and short
-    format of the data size based on the number of commas in the input string `number`.
-    """
-    data_long = {
-        "0": "Bytes",
-        "1": "KiloBytes",
-        "2": "MegaBytes",
-        "3": "GigaBytes",
-        "4": "TeraBytes",
-    }
-    data_short = {
-        "0": "B",
-        "1": "KB",
-        "2": "MB",
-        "3": "GB",
-        "4": "TB",
-    }
-    return [data_long[str(number.count(","))], data_short[str(number.count(","))]]
-
-
-def format_data_into_str(number: int) -> list:
-    """
-    The function `format_data_into_str` takes an integer, formats it with commas, calculates the number
-    of commas, and returns a list with the formatted number and its size in a shorthand format.
-
-    :param number: The function `format_data_into_str` takes an integer `number` as input and formats it
-    into a list of two strings. The first string in the list represents the number in a shortened format
-    with the appropriate size indicator, and the second string represents the number in a similar format
-    but with a different
-    :type number: int
-    :return: The function `format_data_into_str` returns a list containing two formatted strings. The
-    first string is the input number formatted with commas and a size indicator, while the second string
-    is a shorthand version of the input number with a decimal point and a size indicator.
-    """
-    num_as_str = "{:,}".format(number)
-    commas = num_as_str.count(",")
-    if commas == 0:
-        return [
-            num_as_str + " " + format_data_into_size(num_as_str)[0],
-            num_as_str + " " + format_data_into_size(num_as_str)[1],
-        ]
-    shorthand_num = num_as_str.split(",")[0] + "." + num_as_str.split(",")[1][0:2]
-    type_list = format_data_into_size(num_as_str)
-    return [shorthand_num + " " + type_list[0], shorthand_num + " " + type_list[1]]
-
-
-async def get_memory_usage():
-    """
-    This Python async function reads memory information from /proc/meminfo and calculates total, used,
-    and free memory before returning a formatted string with the results.
-    :return: The `get_memory_usage` function is returning a formatted string containing information
-    about memory usage. The string includes the total memory, used memory, and free memory. The values
-    are obtained from reading and parsing the `/proc/meminfo` file in the Linux system.
-    """
-    with open("/proc/meminfo", "r") as meminfo_file:
-        meminfo = meminfo_file.read()
-        memtotal = (
-            int(
-                next(
-                    filter(lambda x: x.startswith("MemTotal"), meminfo.splitlines())
-                ).split()[1]
-            )
-            * 1024
-        )
-        memfree = (
-            int(
-                next(
-                    filter(lambda x: x.startswith("MemFree"), meminfo.splitlines())
-                ).split()[1]
-            )
-            * 1024
-        )
-        memavailable = (
-            int(
-                next(
-                    filter(lambda x: x.startswith("MemAvailable"), meminfo.splitlines())
-                ).split()[1]
-            )
-            * 1024
-        )
-        buffers = (
-            int(
-                next(
-                    filter(lambda x: x.startswith("Buffers"), meminfo.splitlines())
-                ).split()[1]
-            )
-            * 1024
-        )
-        cached = (
-            int(
-                next(
-                    filter(lambda x: x.startswith("Cached"), meminfo.splitlines())
-                ).split()[1]
-            )
-            * 1024
-        )
-        sreclaimable = (
-            int(
-                next(
-                    filter(lambda x: x.startswith("SReclaimable"), meminfo.splitlines())
-                ).split()[1]
-            )
-            * 1024
-        )
-        memused = memtotal - (memfree + buffers + cached + sreclaimable)
-        return f"total: {format_data_into_str(memtotal)[1]} | used: {format_data_into_str(memused)[1]} | free: {format_data_into_str(memavailable)[1]}"
-
-
-def get_cpu_usage_raw():
-    with open("/proc/stat", "r") as f:
-        lines = f.readlines()
-    cpu_usages = []
-    for line in lines:
-        if line.startswith("cpu"):
-            fields = [float(column) for column in line.strip().split()[1:]]
-            # idle time is the fourth column in /proc/stat
-            idle_time = fields[3]
-            total_time = sum(fields)
-            cpu_usages.append((total_time, idle_time))
-    return cpu_usages
-
-
-async def get_cpu_usage():
-    prev_usage = get_cpu_usage_raw()
-    time.sleep(1)
-    curr_usage = get_cpu_usage_raw()
-
-    cpu_pct = []
-    for prev, cur in zip(prev_usage, curr_usage):
-        prev_total, prev_idle = prev
-        cur_total, cur_idle = cur
-
-        total_diff = cur_total - prev_total
-        idle_diff = cur_idle - prev_idle
-
-        cpu_pcts = 100 * (1 - (idle_diff / total_diff))
-        cpu_pct.append(cpu_pcts)
-
-    out_str = ""
-    for i, cpu_p in enumerate(cpu_pct):
-        if i == 0:
-            out_str += f"ALL : {cpu_p:.2f}% | "
-        else:
-            out_str += f"CPU{i-1}: {cpu_p:.2f}% | "
-    return out_str[:-2]
-
-
-async def get_disk_usage():
-    # Get disk space usage
-    statvfs = os.statvfs("/")
-    blksize = statvfs.f_frsize
-    total_blocks = statvfs.f_blocks
-    free_blocks = statvfs.f_bfree
-    avail_blocks = statvfs.f_bavail
-    used_blocks = total_blocks - free_blocks
-    total_final = total_blocks * blksize
-    used_final = used_blocks * blksize
-    avail_final = avail_blocks * blksize
-    return f"total: {format_data_into_str(total_final)[1]} | used: {format_data_into_str(used_final)[1]} | free: {format_data_into_str(avail_final)[1]}"
-
-
 @is_admin
 @check_user_state
 async def list_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -401,7 +321,7 @@ async def add_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
     words_joined = " ".join(context.args)
     words_joined = words_joined.strip()
     out_msg = ""
-    if not " " in words_joined and len(words_joined) > 0:
+    if allow_list.valid_id(words_joined):
         allow_list.add_user(words_joined)
         allow_list.save()
         out_msg = f"Added {words_joined} to the allowed user list."
@@ -424,7 +344,7 @@ async def remove_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
     words_joined = " ".join(context.args)
     words_joined = words_joined.strip()
     out_msg = ""
-    if words_joined not in allow_list.id_list:
+    if not allow_list.user_exists(words_joined):
         await context.bot.send_message(
             chat_id=update.effective_chat.id,
             text=f"{words_joined} is not in the allowed list.",
@@ -481,10 +401,14 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def quote_picker(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.message.from_user
     try:
-        with open(APP_CONFIG.QUOTE_FILE, "r") as f:
-            quote_list = f.readlines()
-        quote_list = [x.strip("\n") for x in quote_list]
-        quote = "<i>" + random.choice(quote_list) + "</i>"
+        if not QUOTES.count:
+            raise Exception("no quotes are loaded")
+        keywords = " ".join(context.args)
+        quote = QUOTES.random_quote(keywords)
+        if quote is None:
+            quote = f"No quotes found about '{html.escape(keywords)}'."
+        else:
+            quote = "<i>" + quote + "</i>"
         await context.bot.send_message(
             chat_id=update.effective_chat.id,
             text=quote,
@@ -534,8 +458,11 @@ async def about_me(update: Update, context: ContextTypes.DEFAULT_TYPE):
 @check_user_state
 async def memory_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.message.from_user
-    mem = await get_memory_usage()
+    mem = get_memory_usage()
     logger.info(f"Sending memory status: {mem}")
+    sample = SYSTEM.latest()
+    if sample is not None:
+        mem += f"\n\n<b>Bot</b> <code>{SYSTEM.process_text(sample)}</code>"
     await context.bot.send_message(
         chat_id=update.effective_chat.id, text=mem, parse_mode=constants.ParseMode.HTML
     )
@@ -545,7 +472,7 @@ async def memory_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
 @check_user_state
 async def disk_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.message.from_user
-    disk = await get_disk_usage()
+    disk = get_disk_usage()
     logger.info(f"Sending disk status: {disk}")
     await context.bot.send_message(
         chat_id=update.effective_chat.id, text=disk, parse_mode=constants.ParseMode.HTML
@@ -556,10 +483,21 @@ async def disk_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
 @check_user_state
 async def cpu_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.message.from_user
-    cpu = await get_cpu_usage()
+    # Only read the buffer; sampling here would shift the sampler's CPU baseline.
+    sample = SYSTEM.latest()
+    if sample is None:
+        await context.bot.send_message(
+            chat_id=update.effective_chat.id, text="Still collecting metrics, try again in a few seconds."
+        )
+        return
+    cpu = " | ".join(
+        f"ALL : {pct:.2f}%" if i == 0 else f"CPU{i-1}: {pct:.2f}%"
+        for i, pct in enumerate(sample.cpu)
+    )
     logger.info(f"Sending cpu status: {cpu}")
+    outstr = f"{cpu}\n\n<b>Average</b> <code>{SYSTEM.history_text('cpu')}</code>"
     await context.bot.send_message(
-        chat_id=update.effective_chat.id, text=cpu, parse_mode=constants.ParseMode.HTML
+        chat_id=update.effective_chat.id, text=outstr, parse_mode=constants.ParseMode.HTML
     )
 
 
@@ -567,14 +505,25 @@ async def cpu_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
 @check_user_state
 async def get_system_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.message.from_user
-    cpu = await get_cpu_usage()
-    cpu = cpu.split("|")[0].split(":")[1].strip()
-    mem = await get_memory_usage()
-    mem = mem.split("|")[2]
-    disk = await get_disk_usage()
-    disk = disk.split("|")[2]
+    # Only read the buffer; sampling here would shift the sampler's CPU baseline.
+    sample = SYSTEM.latest()
+    if sample is None:
+        cpu, mem, disk, bot = ["collecting metrics..."] * 4
+    else:
+        cpu = f"{sample.cpu[0]:.2f}%"
+        mem = f" free: {format_data_into_str(sample.mem_available)[1]}"
+        disk = f" free: {format_data_into_str(sample.disk_free)[1]}"
+        bot = SYSTEM.process_text(sample)
     user_count = users.total_users()
-    outstr = f"<b>[System Stats]</b>\n-----------------------\n CPU 🖥️   <code> {cpu}</code>\nMEM 🤔 <code>{mem}</code>\n DISK 💾 <code>{disk}</code>\n Allow Enabled : <code>{APP_CONFIG.USE_ALLOW_LIST}</code>\n Users Allow-listed: <code>{len(allow_list.id_list)}</code>  /listusers\n Users Active: <code>{user_count}</code> /getuserlist"
+    outstr = f"<b>[System Stats]</b>\n-----------------------\n CPU 🖥️   <code> {cpu}</code>\n CPU avg <code>{SYSTEM.history_text('cpu')}</code>\nMEM 🤔 <code>{mem}</code>\n DISK 💾 <code>{disk}</code>\n BOT 🤖 <code>{bot}</code>\n Allow Enabled : <code>{APP_CONFIG.USE_ALLOW_LIST}</code>\n Users Allow-listed: <code>{len(allow_list)}</code>  /listusers\n Users Active: <code>{user_count}</code> /getuserlist\n Users Saved: <code>{users.stored_users()}</code>"
+    if RESPONSE_CACHE is not None:
+        cache = RESPONSE_CACHE.stats()
+        outstr += f"\n Response cache: <code>{cache['entries']} saved | {cache['hits']} hits | {cache['misses']} misses</code>"
+    usage = USAGE.overall()
+    outstr += f"\n LLM use: <code>{usage.requests} requests | {usage.prompt_tokens + usage.completion_tokens} tokens | ${usage.cost:.2f}</code> /usage"
+    retries = LLM.retry_summary()
+    if retries:
+        outstr += f"\n LLM retries: <code>{retries}</code>"
     logger.info(f"Sending system status.")
     users.update_command(user.id, "/sys", outstr)
     await context.bot.send_message(
@@ -584,13 +533,61 @@ async def get_system_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
 
+@is_admin
+@check_user_state
+async def usage_report(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.message.from_user
+    words_joined = " ".join(context.args).strip().lower()
+    if words_joined in ("csv", "json"):
+        if words_joined == "csv":
+            data = USAGE.export_csv()
+        else:
+            data = USAGE.export_json()
+        logger.info(f"Sending usage export ({words_joined}) to admin.")
+        await context.bot.send_document(
+            chat_id=update.effective_chat.id,
+            document=data.encode(),
+            filename=f"usage_{time.strftime('%Y%m%d_%H%M%S')}.{words_joined}",
+        )
+        return
+    if words_joined == "reset":
+        USAGE.reset()
+        outstr = "Usage totals were reset."
+    else:
+        by = {"users": "user", "chats": "chat", "models": "model"}.get(words_joined, "model")
+        since = time.strftime("%Y-%m-%d %H:%M", time.localtime(USAGE.since))
+        overall = USAGE.overall()
+        outstr = (
+            f"<b>[LLM Usage since {since}]</b>\n-----------------------\n"
+            f"Requests: <code>{overall.requests}</code>\n"
+            f"Tokens: <code>{overall.prompt_tokens} in | {overall.completion_tokens} out</code>\n"
+            f"Cost: <code>${overall.cost:.4f}</code>\n\n<b>By {by}</b>\n"
+        )
+        ranked = sorted(USAGE.rollup(by).items(), key=lambda item: item[1].cost, reverse=True)
+        for name, totals in ranked[:20]:
+            latency = totals.latency / totals.requests if totals.requests else 0.0
+            outstr += (
+                f"<code>{name}</code>: {totals.requests} req | "
+                f"{totals.prompt_tokens + totals.completion_tokens} tok | "
+                f"${totals.cost:.4f} | {latency:.1f}s avg\n"
+            )
+        if overall.estimated:
+            outstr += f"\n<i>{overall.estimated} streamed requests have estimated token counts.</i>"
+    users.update_command(user.id, "/usage", outstr)
+    await context.bot.send_message(
+        chat_id=update.effective_chat.id,
+        text=outstr,
+        parse_mode=constants.ParseMode.HTML,
+    )
+
+
 @is_admin
 @check_user_state
 async def list_all_models(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logger.info(f"Listing all models for Admin.")
     try:
-        gemini_models = LLM.get_gemini_models()
-        openai_models = LLM.get_openai_models()
+        gemini_models = await LLM.get_gemini_models()
+        openai_models = await LLM.get_openai_models()
     except Exception as e:
         logger.error(f"Error getting models: {e}")
         await send_to_admin(
@@ -624,30 +621,43 @@ async def list_commands(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
 
+# Most log records /log sends back (L:#)
+MAX_LOG_LINES = 500
+
+
 @is_admin
 @check_user_state
 async def get_log_lines(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    line_count = 6
-    words_joined = " ".join(context.args) + " "
-    start_location = words_joined.find("L:")
-    if start_location > -1:
-        # change line count
-        end_location = words_joined[start_location:].find(" ")
-        potential_new_num_with_arg = words_joined[start_location:end_location]
-        potential_new_num = potential_new_num_with_arg.split(":")[1].strip()
-        if potential_new_num.isnumeric():
-            line_count = int(potential_new_num)
-    with open(LOGGER_FILE_NAME, "r") as f:
-        lines = f.readlines()
-    outStr = f"[ LAST {line_count} LINES FROM LOG ]\n------------------------------\n"
-    for c, line in enumerate(lines[-line_count:], start=1):
-        outStr += f"[{c}.] - {line}\n"
-    logger.info(f"Admin asked for {line_count} lines of log.")
-    await context.bot.send_message(
-        chat_id=update.effective_chat.id,
-        text=outStr,
-        parse_mode=constants.ParseMode.HTML,
-    )
+    options = log_tools.parse_args(context.args, MAX_LOG_LINES)
+    try:
+        records = await asyncio.to_thread(log_tools.tail, LOGGER_FILE_NAME, **options)
+    except Exception as e:
+        logger.error(f"Could not read the log: {e}")
+        records = []
+    outStr = f"[ LAST {len(records)} LINES FROM LOG ]\n------------------------------\n"
+    for c, line in enumerate(records, start=1):
+        outStr += f"[{c}.] - {html.escape(line)}\n"
+    logger.info(f"Admin asked for {options['count']} lines of log.")
+    await send_chunked(update.effective_chat.id, outStr, context)
+
+
+async def send_chunked(chat_id: int, text: str, context: ContextTypes.DEFAULT_TYPE):
+    """Sends HTML text in as many messages as it takes, split between lines."""
+    # Splitting between lines means an escaped entity (&amp;) is never cut in half.
+    chunk = ""
+    for line in text.splitlines(keepends=True):
+        while len(chunk) + len(line) > 4096:
+            if not chunk:
+                chunk, line = line[:4096], line[4096:]
+            await context.bot.send_message(
+                chat_id=chat_id, text=chunk, parse_mode=constants.ParseMode.HTML
+            )
+            chunk = ""
+        chunk += line
+    if chunk:
+        await context.bot.send_message(
+            chat_id=chat_id, text=chunk, parse_mode=constants.ParseMode.HTML
+        )
 
 
 @is_admin
@@ -658,16 +668,17 @@ async def admin_help_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # reader function to read and display this.
     msg = """
         <b>System Commands</b>
-        /mem -- Free memory detail
-        /cpu -- Used CPU detail
+        /mem -- Free memory detail, plus the bot's own memory, open files, threads and event loop lag
+        /cpu -- Used CPU detail, with 1/5/15 minute averages
         /disk -- Used disk detail
         /sys -- brief of the above
-        /log -- get last 6 log lines (use L:# to change lines and put a space after the number)
+        /log -- get last 6 log lines.  Options: L:# lines (up to 500), grep:text, level:warning (or higher), since:30m / since:2024-06-01T10:00, until:...
         /restart -- restarts  the telegram bot with a delay
         /listmodels -- lists all models for all LLM's that are in use.
         /model [chatgpt|gemini] [modelname] -- change the model being used.  Empty command will return the models in use."
         /savemodels -- saves the models in use so they are persistent through reload/reboot.
         /searchmodels [txt] -- search models for text i.e. /searchmodels o3
+        /usage [users|chats|models] -- token use and cost so far.  <code>/usage csv</code> or <code>/usage json</code> sends an export, <code>/usage reset</code> starts over.
 
         
         <b>Working with saved items</b>
@@ -921,6 +932,64 @@ async def unknown(update: Update, context: ContextTypes.DEFAULT_TYPE):
         text="Sorry, I didn't understand that command.",
     )
 
+async def cross_check_pipeline(
+    prompt: str, reply: ProgressiveReply, fast: bool = False, user_id=None, chat_id=None
+) -> tuple[dict, str]:
+    """
+    Sends the prompt to Gemini and ChatGPT at the same time, then has ChatGPT refine the
+    drafts.  With `fast` the first draft to arrive is shown right away and the refined
+    answer is edited in when it's ready.  Returns ({model: draft}, refined answer).
+    """
+    ids = {"user_id": user_id, "chat_id": chat_id}
+    if APP_CONFIG.GEMINI_MODEL == "default":
+        gemini_call = LLM.google_gemini(prompt, use_cache=True, **ids)
+    else:
+        gemini_call = LLM.google_gemini(
+            prompt, model_to_use=APP_CONFIG.GEMINI_MODEL, use_cache=True, **ids
+        )
+    if APP_CONFIG.CHAT_GPT_MODEL == "default":
+        gpt_call = LLM.gpt_4(prompt, use_cache=True, **ids)
+    else:
+        gpt_call = LLM.gpt_4(prompt, openAI_model=APP_CONFIG.CHAT_GPT_MODEL, use_cache=True, **ids)
+
+    async def labelled(name, call):
+        return name, await call
+
+    tasks = [
+        asyncio.create_task(labelled("Gemini", gemini_call)),
+        asyncio.create_task(labelled("ChatGPT", gpt_call)),
+    ]
+    drafts = {}
+    shown_first = False
+    for finished in asyncio.as_completed(tasks):
+        try:
+            name, text = await finished
+        except Exception as e:
+            # One model failing shouldn't sink the cross check; the other draft still counts.
+            logger.error(f" -- a model failed in /cross: {e}")
+            continue
+        drafts[name] = text
+        logger.info(f" ++ {name} sent in /cross")
+        if fast and not shown_first:
+            shown_first = True
+            await reply.replace(
+                f"<b>(first answer, from {name})</b>: \n{html.escape(text)}\n\n<i>Refining...</i>"
+            )
+    if not drafts:
+        raise Exception("Neither Gemini nor ChatGPT answered the cross check.")
+
+    answers = " and ".join(f"```{text}```" for text in drafts.values())
+    new_words = f"Previous, I asked ```{prompt}``` and got the answer {answers}.  Can you improve upon it? please respond with either this answer I already have or a new answer improving upon this answer.  Please don't give a description of the old answer and improvements."
+    if APP_CONFIG.CHAT_GPT_MODEL == "default":
+        gpt_response = await LLM.gpt_4(new_words, use_cache=True, **ids)
+    else:
+        gpt_response = await LLM.gpt_4(
+            new_words, openAI_model=APP_CONFIG.CHAT_GPT_MODEL, use_cache=True, **ids
+        )
+    logger.info(" ++ ChatGPT refined in /cross")
+    return drafts, gpt_response
+
+
 @is_user_allowed
 @check_user_state
 async def cross_check(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -929,46 +998,36 @@ async def cross_check(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logger.info(f"User ({user.id} | {user.name}) is using /cross")
     if not words_joined == "":
         msg_to_file = f"(Cross Check -> Gemini) {user.username} '{words_joined}' : "
+        fast = APP_CONFIG.CROSS_FAST_REPLY
+        if "fast:y" in words_joined:
+            words_joined = words_joined.replace("fast:y", "")
+            fast = True
+        reply = None
         try:
             # DON'T keep the record.
             users.update_prompt(user.id, users.LLMTypes.BOTH)
-            if APP_CONFIG.GEMINI_MODEL == "default":
-                words_from_gemini = LLM.google_gemini(words_joined)
-            else:
-                words_from_gemini = LLM.google_gemini(words_joined, model_to_use=APP_CONFIG.GEMINI_MODEL)
-            # limit on how big a msg can be so break it up.
-            logger.info(" ++ Gemini sent in /cross")
-            with open(APP_CONFIG.CHAT_FILE, "a") as f:
-                msg_to_file = msg_to_file + f"CROSS_CHECK->'{words_from_gemini}'"
-                f.write(msg_to_file + "\n")
-            # logger.info(f" REPLY from Google Gemini (cross check)= {words_from_gemini}")
-            new_words = f"Previous, I asked ```{words_joined}``` and got the answer ```{words_from_gemini}```.  Can you improve upon it? please respond with either this answer I already have or a new answer improving upon this answer.  Please don't give a description of the old answer and improvements."
-            if APP_CONFIG.CHAT_GPT_MODEL == "default":
-                gpt_response = LLM.gpt_4(new_words)
-            else:
-                gpt_response = LLM.gpt_4(new_words, openAI_model=APP_CONFIG.CHAT_GPT_MODEL)
-            logger.info(" ++ ChatGPT sent in /cross")
-            # logger.info(f" REPLY from GPT (cross check) = {gpt_response}")
-            with open(APP_CONFIG.CHAT_FILE, "a") as f:
-                msg_to_file = msg_to_file + f"CROSS_CHECK->'{gpt_response}'"
-                f.write(msg_to_file + "\n")
+            reply = ProgressiveReply(update.message, logger, parse_mode=constants.ParseMode.HTML)
+            await reply.start()
+            drafts, gpt_response = await cross_check_pipeline(
+                words_joined, reply, fast, user_id=user.id, chat_id=update.effective_chat.id
+            )
+            words_from_gemini = drafts.get("Gemini") or drafts["ChatGPT"]
+            msg_to_file = msg_to_file + f"CROSS_CHECK->'{words_from_gemini}'"
+            TRANSCRIPT.write(msg_to_file)
+            msg_to_file = msg_to_file + f"CROSS_CHECK->'{gpt_response}'"
+            TRANSCRIPT.write(msg_to_file)
             # This line is to give a user their original answer + the refined one.
             refined = (
                 "<b>(unrefined message)</b>: \n"
-                + words_from_gemini
+                + html.escape(words_from_gemini)
                 + "\n\n<b>(Revised message)</b>\n"
-                + gpt_response
+                + html.escape(gpt_response)
             )
-            msgs = [refined[i: i + 4094] for i in range(0, len(refined), 4096)]
-            for text_out in msgs:
-                # await update.message.reply_text(text=text_out)
-                await context.bot.send_message(
-                    chat_id=update.effective_chat.id,
-                    text=text_out,
-                    parse_mode=constants.ParseMode.HTML,
-                )
+            await reply.finish(refined)
             return
         except Exception as e:
+            if reply is not None:
+                await reply.discard()
             await send_to_admin(
                 f"CHAT_COMMAND -(Cross Check)- user: {user.username}:{user.id} got error :{e}",
                 context,
@@ -977,9 +1036,7 @@ async def cross_check(update: Update, context: ContextTypes.DEFAULT_TYPE):
             logger.info(f"Error sending chat.  Error: {e}")
     else:
         words_joined = "There was nothing to send to the LLMs.  Try typing \n/cross <i>message here...</i>\nto send a message to Google Gemini."
-    with open(APP_CONFIG.CHAT_FILE, "a") as f:
-        msg_to_file = f"'{words_joined}'"
-        f.write(msg_to_file + "\n")
+    TRANSCRIPT.write(f"'{words_joined}'")
     await send_to_admin(
         f"CHAT_COMMAND -(Cross Check)- user: {user.username}:{user.id} got error :{words_joined}",
         context,
@@ -998,27 +1055,41 @@ async def google_gemini_chat(update: Update, context: ContextTypes.DEFAULT_TYPE)
     if not words_joined == "":
         logger.info(f"User {user.name} sending prompt Google Gemini")
         msg_to_file = f"(Google Gemini) {user.username} '{words_joined}' : "
+        reply = None
         try:
-            # Create a prompt for state-history
-            last_prompt = users.get_last_prompt(user.id)
-            if last_prompt["prompt"]:
-                words_joined_final = f"Last time I asked : ```{last_prompt['prompt']}``` and you replied ```{last_prompt['prompt_result']}```.  ```Now i'm asking {words_joined}```"
-            elif last_prompt["prompt_result"]:
-                words_joined_final = f"Recently you told me ```{last_prompt['prompt_result']}```.  ```Now i'm asking {words_joined}```"
-            else:
-                words_joined_final = words_joined
+            # Earlier exchanges in this chat, trimmed to the model's budget
+            history = CONVERSATIONS.history(
+                update.effective_chat.id,
+                user.id,
+                APP_CONFIG.history_budget(APP_CONFIG.GEMINI_MODEL),
+                "gemini",
+            )
             # add lastest prompt.
             users.update_prompt(
                 user.id, UserStates.LLMTypes.GEMINI, prompt=words_joined
             )
+            reply = ProgressiveReply(update.message, logger)
+            await reply.start()
+            # Only prompts without any history are worth caching.
             if APP_CONFIG.GEMINI_MODEL == "default":
-                words_joined = LLM.google_gemini(words_joined_final)
+                pieces = LLM.google_gemini_stream(
+                    words_joined, use_cache=not history, history=history,
+                    user_id=user.id, chat_id=update.effective_chat.id,
+                )
             else:
-                words_joined = LLM.google_gemini(words_joined_final, model_to_use=APP_CONFIG.GEMINI_MODEL)
-            # limit on how big a msg can be so break it up.
-            with open(APP_CONFIG.CHAT_FILE, "a") as f:
-                msg_to_file = msg_to_file + f"'{words_joined}'"
-                f.write(msg_to_file + "\n")
+                pieces = LLM.google_gemini_stream(
+                    words_joined, model_to_use=APP_CONFIG.GEMINI_MODEL, use_cache=not history,
+                    history=history, user_id=user.id, chat_id=update.effective_chat.id,
+                )
+            # Closes the stream (and frees its rate limit slot) if we stop early.
+            async with contextlib.aclosing(pieces):
+                async for piece in pieces:
+                    await reply.push(piece)
+            # the reply spills into more messages past the 4096 character limit.
+            prompt = words_joined
+            words_joined = await reply.finish()
+            CONVERSATIONS.add_exchange(update.effective_chat.id, user.id, prompt, words_joined)
+            TRANSCRIPT.write(msg_to_file + f"'{words_joined}'")
             # add latest result.
             users.update_prompt(
                 user.id,
@@ -1026,13 +1097,10 @@ async def google_gemini_chat(update: Update, context: ContextTypes.DEFAULT_TYPE)
                 prompt_result=words_joined,
                 do_not_increase=True,
             )
-            msgs = [
-                words_joined[i: i + 4094] for i in range(0, len(words_joined), 4096)
-            ]
-            for text_out in msgs:
-                await update.message.reply_text(text=text_out)
             return
         except Exception as e:
+            if reply is not None:
+                await reply.discard()
             await send_to_admin(
                 f"CHAT_COMMAND -(Google Gemini)- user: {user.username}:{user.id} got error :{e}",
                 context,
@@ -1041,9 +1109,7 @@ async def google_gemini_chat(update: Update, context: ContextTypes.DEFAULT_TYPE)
             logger.info(f"Error sending chat to Google Gemini.  Error: {e}")
     else:
         words_joined = "There was nothing to send to Google Gemini.  Try typing \n/g <i>message here...</i>\nto send a message to Google Gemini."
-    with open(APP_CONFIG.CHAT_FILE, "a") as f:
-        msg_to_file = f"'{words_joined}'"
-        f.write(msg_to_file + "\n")
+    TRANSCRIPT.write(f"'{words_joined}'")
     await send_to_admin(
         f"CHAT_COMMAND -(Google Gemini)- user: {user.username}:{user.id} got error :{words_joined}",
         context,
@@ -1070,42 +1136,46 @@ async def chat_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if "t:l" in words_joined:
             words_joined = words_joined.replace("t:l", "")
             temp = 0
+        reply = None
         try:
-            # Create a prompt for state-history
-            last_prompt = users.get_last_prompt(user.id)
-            if last_prompt["prompt"]:
-                words_joined_final = f"Last time I asked : ```{last_prompt['prompt']}``` and you replied ```{last_prompt['prompt_result']}```.  ```Now i'm asking {words_joined}```"
-            elif last_prompt["prompt_result"]:
-                words_joined_final = f"Recently you told me ```{last_prompt['prompt_result']}```.  ```Now i'm asking {words_joined}```"
-            else:
-                words_joined_final = words_joined
+            # Earlier exchanges in this chat, trimmed to the model's budget
+            history = CONVERSATIONS.history(
+                update.effective_chat.id, user.id, APP_CONFIG.history_budget(APP_CONFIG.CHAT_GPT_MODEL)
+            )
             # add lastest prompt.
             users.update_prompt(user.id, UserStates.LLMTypes.GPT, prompt=words_joined)
+            reply = ProgressiveReply(update.message, logger)
+            await reply.start()
+            # Only prompts without any history are worth caching.
             if APP_CONFIG.CHAT_GPT_MODEL == "default":
-                words_joined = LLM.gpt_4(
-                    message=words_joined_final, temp=temp
+                pieces = LLM.gpt_4_stream(
+                    message=words_joined, temp=temp, use_cache=not history, history=history,
+                    user_id=user.id, chat_id=update.effective_chat.id,
                 )  # Using GPT-4
             else:
-                words_joined = LLM.gpt_4(
-                    message=words_joined_final, temp=temp, openAI_model=APP_CONFIG.CHAT_GPT_MODEL
+                pieces = LLM.gpt_4_stream(
+                    message=words_joined, temp=temp, openAI_model=APP_CONFIG.CHAT_GPT_MODEL,
+                    use_cache=not history, history=history,
+                    user_id=user.id, chat_id=update.effective_chat.id,
                 )
-            # limit on how big a msg can be so break it up.
+            async with contextlib.aclosing(pieces):
+                async for piece in pieces:
+                    await reply.push(piece)
+            # the reply spills into more messages past the 4096 character limit.
+            prompt = words_joined
+            words_joined = await reply.finish()
+            CONVERSATIONS.add_exchange(update.effective_chat.id, user.id, prompt, words_joined)
             users.update_prompt(
                 user.id,
                 UserStates.LLMTypes.GPT,
                 prompt_result=words_joined,
                 do_not_increase=True,
             )
-            with open(APP_CONFIG.CHAT_FILE, "a") as f:
-                msg_to_file = msg_to_file + f"'{words_joined}'"
-                f.write(msg_to_file + "\n")
-            msgs = [
-                words_joined[i: i + 4094] for i in range(0, len(words_joined), 4096)
-            ]
-            for text_out in msgs:
-                await update.message.reply_text(text=text_out)
+            TRANSCRIPT.write(msg_to_file + f"'{words_joined}'")
             return
         except Exception as e:
+            if reply is not None:
+                await reply.discard()
             await send_to_admin(
                 f"CHAT_COMMAND -- user: {user.username}:{user.id} got error :{e}",
                 context,
@@ -1116,9 +1186,7 @@ async def chat_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             logger.info(f"Error sending chat to GPT.  Error: {e}")
     else:
         words_joined = "There was nothing to send to ChatGPT.  Try typing \n/c <i>message here...</i>\nto send a message to ChatGPT."
-    with open(APP_CONFIG.CHAT_FILE, "a") as f:
-        msg_to_file = f"'{words_joined}'"
-        f.write(msg_to_file + "\n")
+    TRANSCRIPT.write(f"'{words_joined}'")
     await send_to_admin(
         f"CHAT_COMMAND -- user: {user.username}:{user.id} got error :{words_joined}",
         context,
@@ -1129,6 +1197,17 @@ async def chat_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         parse_mode=constants.ParseMode.HTML,
     )
 
+@is_user_allowed
+@check_user_state
+async def forget_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.message.from_user
+    CONVERSATIONS.clear(update.effective_chat.id, user.id)
+    logger.info(f"User {user.name} cleared their conversation history")
+    await context.bot.send_message(
+        chat_id=update.effective_chat.id,
+        text="Done, I've forgotten our conversation in this chat.",
+    )
+
 @is_user_allowed
 @check_user_state
 async def dall_e_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1152,19 +1231,29 @@ async def dall_e_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 quality = "hd"
                 words_joined = words_joined.replace("q:hd", "")
             original_prompt = words_joined
-            words_joined = LLM.dall_E_3(words_joined, size=size, quality=quality)
+            words_joined = await LLM.dall_E_3(
+                words_joined, size=size, quality=quality,
+                user_id=user.id, chat_id=update.effective_chat.id,
+            )
+            if not words_joined.startswith("http"):
+                raise Exception(f"DALL-E gave no image: {words_joined}")
             # Now, save the file incoming.
-            save_dir = os.path.join(os.getcwd(), "images")
             filename = (
                 str(user.id) + "_" + create_random_filename(20) + ".png"
             )  # GPT returns PNG
-            file_save_with_dir = os.path.join(save_dir, filename)
-            file_data = requests.get(words_joined)
-            with open(file_save_with_dir, "wb") as f:
-                f.write(file_data.content)
+            image_bytes = await IMAGES.download(words_joined, filename)
             # update user prompt for pic
             users.update_pic(user.id, prompt=original_prompt, prompt_result=filename)
             logger.info(f"Saved image from {user.id} : {user.name} as {filename}")
+            TRANSCRIPT.write(msg_to_file + f"'{words_joined}'")
+            await context.bot.send_photo(
+                chat_id=update.effective_chat.id,
+                photo=image_bytes,
+                filename=filename,
+                caption=f"Your image ({size})\n #images_{user.id}\n <code>{filename}</code>",
+                parse_mode=constants.ParseMode.HTML,
+            )
+            return
         except Exception as e:
             words_joined = (
                 "Looks like that's not an allowed prompt.  It's been rejected!"
@@ -1175,13 +1264,12 @@ async def dall_e_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 context,
             )
         msg_to_file = msg_to_file + f"'{words_joined}'"
-        with open(APP_CONFIG.CHAT_FILE, "a") as f:
-            f.write(msg_to_file + "\n")
+        TRANSCRIPT.write(msg_to_file)
     else:
         words_joined = "There was nothing to send to DALL-E.  Try typing \n/p <i>message here...</i>\nto send a message to DALL-E."
     await context.bot.send_message(
         chat_id=update.effective_chat.id,
-        text=f"Your image ({size})\n #images_{user.id}\n <code>{filename}</code>\n " + words_joined,
+        text=words_joined,
         parse_mode=constants.ParseMode.HTML,
     )
 
@@ -1244,6 +1332,124 @@ async def send_alive_msg(message: str):
     await application.bot.send_message(chat_id=APP_CONFIG.ADMIN, text=message)
 
 
+def log_config_changes(changes: dict) -> None:
+    for name, (old, new) in changes.items():
+        if "KEY" in name:
+            logger.info(f"Config reload: {name} changed")
+        else:
+            logger.info(f"Config reload: {name} {old!r} -> {new!r}")
+
+
+def reopen_allow_list():
+    CONFIG_WATCHER.unwatch(allow_list.filename)
+    allow_list.filename = APP_CONFIG.ALLOW_LIST_FILENAME
+    allow_list.load()
+    CONFIG_WATCHER.watch(allow_list.filename, reload_allow_list)
+    logger.info(f"Allow list now read from {allow_list.filename} ({len(allow_list)} users)")
+
+
+def rewatch_quote_files():
+    for filename in QUOTES.filenames:
+        CONFIG_WATCHER.unwatch(filename)
+    QUOTES.filenames = APP_CONFIG.quote_files()
+    QUOTES.load()
+    for filename in QUOTES.filenames:
+        CONFIG_WATCHER.watch(filename, QUOTES.load)
+
+
+def apply_tunable_settings():
+    # Cheap to copy, so these are set on every reload whether they changed or not.
+    CONVERSATIONS.max_turns = APP_CONFIG.HISTORY_TURNS
+    CONVERSATIONS.summary_tokens = APP_CONFIG.HISTORY_SUMMARY_TOKENS
+    users.idle_ttl = APP_CONFIG.USER_STATE_IDLE_TTL
+    users.max_resident = APP_CONFIG.USER_STATE_MAX_RESIDENT
+    LISTEN_BATCHER.window = APP_CONFIG.LISTEN_WINDOW
+    TRANSCRIPT.max_bytes = APP_CONFIG.TRANSCRIPT_MAX_BYTES
+    TRANSCRIPT.backups = APP_CONFIG.TRANSCRIPT_BACKUPS
+    TRANSCRIPT.compress = APP_CONFIG.TRANSCRIPT_COMPRESS
+    LISTEN_BATCHER.mode = APP_CONFIG.LISTEN_MODE
+    LISTEN_BATCHER.max_queue = APP_CONFIG.LISTEN_MAX_QUEUE
+
+
+# What to redo when any of a group of settings changes on reload.
+CONFIG_RELOADERS = [
+    (RATE_LIMIT_SETTINGS, lambda: LLM.rate_limiter.reset()),
+    ({"ALLOW_LIST_FILENAME"}, reopen_allow_list),
+    ({"QUOTE_FILE"}, rewatch_quote_files),
+    ({name for name, _ in SETTINGS.values() if name.startswith("LOG_")}, configure_logging),
+    ({"MODEL_PRICES"}, lambda: USAGE.prices.update(APP_CONFIG.MODEL_PRICES)),
+]
+
+
+async def reload_config():
+    changes = APP_CONFIG.reload()
+    if not changes:
+        return
+    log_config_changes(changes)
+    if changes.keys() & {"CHAT_GPT_KEY", "GEMINI_KEY"}:
+        await LLM.reset_clients()
+    for settings, reload in CONFIG_RELOADERS:
+        if changes.keys() & settings:
+            reload()
+    apply_tunable_settings()
+    for name in changes.keys() & RESTART_ONLY_SETTINGS:
+        logger.warning(f"Config reload: {name} only takes effect after /restart")
+
+
+def reload_allow_list():
+    added, removed = allow_list.reload()
+    if added or removed:
+        logger.info(f"Allow list reload: added {added}, removed {removed}")
+
+
+CONFIG_WATCHER.watch(APP_CONFIG.filename, reload_config)
+CONFIG_WATCHER.watch(allow_list.filename, reload_allow_list)
+for quote_file in QUOTES.filenames:
+    CONFIG_WATCHER.watch(quote_file, QUOTES.load)
+
+
+async def set_log_context(update: object, context: ContextTypes.DEFAULT_TYPE):
+    # Runs first for every update so its log lines carry the update and user IDs.
+    if isinstance(update, Update):
+        REQUEST_ID.set(update.update_id)
+        USER_ID.set(update.effective_user.id if update.effective_user else None)
+
+
+async def startup_services(application):
+    BACKGROUND_TASKS.append(asyncio.create_task(CONFIG_WATCHER.run()))
+    BACKGROUND_TASKS.append(asyncio.create_task(TRANSCRIPT.run()))
+    BACKGROUND_TASKS.append(asyncio.create_task(SYSTEM.run()))
+    BACKGROUND_TASKS.append(
+        asyncio.create_task(users.run_saver(APP_CONFIG.USER_STATE_FLUSH))
+    )
+    BACKGROUND_TASKS.append(
+        asyncio.create_task(CONVERSATIONS.run_saver(APP_CONFIG.USER_STATE_FLUSH))
+    )
+    BACKGROUND_TASKS.append(
+        asyncio.create_task(USAGE.run_saver(APP_CONFIG.USAGE_FLUSH))
+    )
+
+
+async def shutdown_services(application):
+    # Release long-lived resources (pooled connections, buffers) on the way out.
+    logger.info("Shutting down services.")
+    for task in BACKGROUND_TASKS:
+        task.cancel()
+    await asyncio.gather(*BACKGROUND_TASKS, return_exceptions=True)
+    BACKGROUND_TASKS.clear()
+    await LISTEN_BATCHER.close()
+    TRANSCRIPT.close()
+    users.save_users()
+    CONVERSATIONS.save()
+    USER_STORE.close()
+    CHAT_PROPS.flush()
+    USAGE.save()
+    await LLM.close()
+    await IMAGES.close()
+    if RESPONSE_CACHE is not None:
+        RESPONSE_CACHE.save()
+
+
 @is_admin
 @check_user_state
 async def get_image_by_file_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1439,8 +1645,8 @@ async def search_models(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
     msg_out = "Search results:\n"
-    gpt_models = LLM.get_openai_models()
-    gemini_models = LLM.get_gemini_models()
+    gpt_models = await LLM.get_openai_models()
+    gemini_models = await LLM.get_gemini_models()
     pre = r""
     post = r""
     logger.info(f"searching modles for string: '{words_joined}'")
@@ -1502,27 +1708,107 @@ async def listen_stop(update: Update, context: ContextTypes.DEFAULT_TYPE):
         parse_mode=constants.ParseMode.HTML,
     )
 
+class ListenedChatFilter(filters.MessageFilter):
+    """
+    Lets through only messages from chats with /listen on.  Runs before any handler, so
+    traffic from other chats costs one set lookup.
+    """
+
+    def filter(self, message: Message) -> bool:
+        return CHAT_PROPS.is_listening(str(message.chat_id))
+
+
+# Conversation history and usage of listened chats are kept per chat under this ID.
+LISTEN_USER_ID = "listen"
+
+
 async def listening_bot(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     props = CHAT_PROPS.get_chat(str(chat_id))
-    if not props["listening"]:
+    # The filter already checked, but /stop may have landed since the update was queued.
+    if props is None or not props.listening:
         return
-    model = props["model"]
     text = update.message.text.strip()
     if not text or text.startswith("/"):
         return   # ignore empty or other commands
-    # send to existing handlers
-    logging.info(f"{update.message.from_user.name} sending message -> processing via listening mode")
-    if model == "chatgpt":
-        context.args = [text]
-        await chat_command(update, context)
-    else:
-        context.args = [text]
-        await google_gemini_chat(update, context)
+    user = update.message.from_user
+    # Checked per message: everything in a batch goes to the LLM together.
+    if not user_allowed(str(user.id)):
+        logger.debug(f"Not passing on listened message from {user.id}, not allowed")
+        return
+    reply_to = update.message.reply_to_message
+    mentioned = f"@{context.bot.username}".lower() in text.lower() or (
+        reply_to is not None
+        and reply_to.from_user is not None
+        and reply_to.from_user.id == context.bot.id
+    )
+    # Batched with the chat's other recent messages, answered by answer_listened_chat.
+    LISTEN_BATCHER.add(chat_id, user.first_name or user.name, text, update, context, mentioned)
+
+
+async def answer_listened_chat(update: Update, context: ContextTypes.DEFAULT_TYPE, prompt: str):
+    # The prompt holds several people's messages, so it goes straight to the LLM instead of
+    # through /c or /g (those check and count the sender of the last message only).  The
+    # chat's conversation history and usage are kept under LISTEN_USER_ID, not any one user.
+    chat_id = update.effective_chat.id
+    props = CHAT_PROPS.get_chat(str(chat_id))
+    if props is None or not props.listening:
+        return
+    logger.info(f"Answering listened chat {chat_id} with {props.model}")
+    reply = None
+    try:
+        if props.model == "chatgpt":
+            history = CONVERSATIONS.history(
+                chat_id, LISTEN_USER_ID, APP_CONFIG.history_budget(APP_CONFIG.CHAT_GPT_MODEL)
+            )
+            model = {} if APP_CONFIG.CHAT_GPT_MODEL == "default" else {"openAI_model": APP_CONFIG.CHAT_GPT_MODEL}
+            pieces = LLM.gpt_4_stream(
+                message=prompt, history=history, user_id=LISTEN_USER_ID, chat_id=chat_id, **model
+            )
+        else:
+            history = CONVERSATIONS.history(
+                chat_id, LISTEN_USER_ID, APP_CONFIG.history_budget(APP_CONFIG.GEMINI_MODEL), "gemini"
+            )
+            model = {} if APP_CONFIG.GEMINI_MODEL == "default" else {"model_to_use": APP_CONFIG.GEMINI_MODEL}
+            pieces = LLM.google_gemini_stream(
+                prompt, history=history, user_id=LISTEN_USER_ID, chat_id=chat_id, **model
+            )
+        reply = ProgressiveReply(update.message, logger)
+        await reply.start()
+        async with contextlib.aclosing(pieces):
+            async for piece in pieces:
+                await reply.push(piece)
+        answer = await reply.finish()
+        CONVERSATIONS.add_exchange(chat_id, LISTEN_USER_ID, prompt, answer)
+        TRANSCRIPT.write(f"(Listening {props.model}) chat {chat_id} '{prompt}' : '{answer}'")
+    except Exception as e:
+        if reply is not None:
+            await reply.discard()
+        logger.error(f"Error answering listened chat {chat_id}: {e}")
+        await send_to_admin(f"LISTENING -- chat: {chat_id} got error :{e}", context)
+
+
+# Merges the messages of listened chats into one prompt per window (or per mention)
+LISTEN_BATCHER = ListenBatcher(
+    logger,
+    answer_listened_chat,
+    window=APP_CONFIG.LISTEN_WINDOW,
+    mode=APP_CONFIG.LISTEN_MODE,
+    max_queue=APP_CONFIG.LISTEN_MAX_QUEUE,
+)
 
 if __name__ == "__main__":
 
-    application = ApplicationBuilder().token(APP_CONFIG.BOT_KEY).build()
+    application = (
+        ApplicationBuilder()
+        .token(APP_CONFIG.BOT_KEY)
+        .concurrent_updates(APP_CONFIG.CONCURRENT_UPDATES)
+        .post_init(startup_services)
+        .post_shutdown(shutdown_services)
+        .build()
+    )
+
+    application.add_handler(TypeHandler(Update, set_log_context), group=-1)
 
     start_handler = CommandHandler("start", start)
     pr_handler = CommandHandler("pr", pr)
@@ -1532,6 +1818,7 @@ if __name__ == "__main__":
     frog_handler = CommandHandler("frog", frog)
     unknown_handler = MessageHandler(filters.COMMAND, unknown)
     chatgpt_handler = CommandHandler("c", chat_command)
+    forget_handler = CommandHandler("forget", forget_command)
     google_gemini_handler = CommandHandler("g", google_gemini_chat)
     cross_check_handler = CommandHandler("cross", cross_check)
     dall_e_small_handler = CommandHandler("p", dall_e_command)
@@ -1543,6 +1830,7 @@ if __name__ == "__main__":
     examples_html_handler = CommandHandler("html", give_examples_html)
     admin_helptext_handler = CommandHandler("admin", admin_help_text)
     get_system_status_handler = CommandHandler("sys", get_system_status)
+    usage_handler = CommandHandler("usage", usage_report)
     get_log_lines_handler = CommandHandler("log", get_log_lines)
     view_allow_list_handler = CommandHandler("listusers", list_users)
     add_allow_list_handler = CommandHandler("adduser", add_user)
@@ -1576,6 +1864,7 @@ if __name__ == "__main__":
     application.add_handler(feedback_handler)
     application.add_handler(dall_e_small_handler)
     application.add_handler(chatgpt_handler)
+    application.add_handler(forget_handler)
     application.add_handler(start_handler)
     application.add_handler(pr_handler)
     application.add_handler(list_handler)
@@ -1585,6 +1874,7 @@ if __name__ == "__main__":
     application.add_handler(examples_html_handler)
     application.add_handler(admin_helptext_handler)
     application.add_handler(get_system_status_handler)
+    application.add_handler(usage_handler)
     application.add_handler(get_log_lines_handler)
     application.add_handler(view_allow_list_handler)
     application.add_handler(add_allow_list_handler)
@@ -1608,7 +1898,9 @@ if __name__ == "__main__":
     application.add_handler(listen_stop_handler)
     application.add_handler(unknown_handler)
     application.add_handler(
-        MessageHandler(filters.TEXT & (~filters.COMMAND), listening_bot)
+        MessageHandler(
+            filters.TEXT & (~filters.COMMAND) & ListenedChatFilter(), listening_bot
+        )
     )
 
     asyncio.get_event_loop().run_until_complete(
@@ -1616,12 +1908,17 @@ if __name__ == "__main__":
     )
 
     # Get gemini models
-    gemini_models = LLM.get_gemini_models()  # get gemini models for printing to log
+    gemini_models = asyncio.get_event_loop().run_until_complete(
+        LLM.get_gemini_models()
+    )  # get gemini models for printing to log
     logger.info(f"There are {len(gemini_models)} Gemini models and they are : {', '.join(gemini_models)}")
 
     # Get OpenAI models
-    openai_models = LLM.get_openai_models()
+    openai_models = asyncio.get_event_loop().run_until_complete(
+        LLM.get_openai_models()
+    )
     logger.info(f"There are {len(openai_models)} OpenAI models and they are : {', '.join(openai_models)}")
 
     logger.info(" 🎇 TGram is starting! 😇 ")
     application.run_polling()
+    LOGS.stop()
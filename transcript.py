@@ -0,0 +1,125 @@
+# Writes the chat transcript (CHAT_FILE) in the background instead of on the event loop.
+import asyncio
+import gzip
+import logging
+import os
+import shutil
+import threading
+
+
+class TranscriptWriter:
+    """
+    Handlers call write() with a line; a background task (run()) takes lines off an asyncio
+    queue and appends them in batches through one open file handle.  A batch is written
+    once it has `batch_size` lines or `flush_interval` seconds after its first line.
+    Past `max_bytes` the file is rotated to file.1, file.2, ... (gzipped with `compress`),
+    keeping `backups` old files.
+    """
+
+    def __init__(
+        self,
+        logger: logging.Logger,
+        filename: str,
+        max_bytes: int = 10 * 1024 * 1024,
+        backups: int = 5,
+        compress: bool = False,
+        flush_interval: float = 1.0,
+        batch_size: int = 200,
+        max_queue: int = 10000,
+    ) -> None:
+        self.logger = logger.getChild("transcript")
+        self.filename = filename
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.compress = compress
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.queue = asyncio.Queue(maxsize=max_queue)
+        self.handle = None
+        # A write cancelled on shutdown keeps running in its thread; this keeps the
+        # final writes and close() from touching the file at the same time.
+        self.file_lock = threading.Lock()
+        self.dropped = 0
+
+    def write(self, line: str) -> None:
+        try:
+            self.queue.put_nowait(line if line.endswith("\n") else line + "\n")
+        except asyncio.QueueFull:
+            self.dropped += 1
+            if self.dropped == 1 or self.dropped % 1000 == 0:
+                self.logger.warning(f"Transcript queue is full, {self.dropped} lines dropped")
+
+    async def run(self) -> None:
+        # Background task, started in startup_services.
+        loop = asyncio.get_running_loop()
+        lines = []
+        try:
+            while True:
+                lines.append(await self.queue.get())
+                deadline = loop.time() + self.flush_interval
+                while len(lines) < self.batch_size:
+                    try:
+                        lines.append(self.queue.get_nowait())
+                        continue
+                    except asyncio.QueueEmpty:
+                        pass
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        lines.append(await asyncio.wait_for(self.queue.get(), timeout))
+                    except asyncio.TimeoutError:
+                        break
+                # Hand the batch over first: if we're cancelled while the thread writes it,
+                # the finally below mustn't write it a second time.
+                batch, lines = lines, []
+                await asyncio.to_thread(self.write_lines, batch)
+        finally:
+            # Cancelled on shutdown; don't lose the batch being collected.
+            if lines:
+                self.write_lines(lines)
+
+    def write_lines(self, lines: list[str]) -> None:
+        with self.file_lock:
+            self.append(lines)
+
+    def append(self, lines: list[str]) -> None:
+        try:
+            if self.handle is None:
+                self.handle = open(self.filename, "a", encoding="utf-8")
+            self.handle.write("".join(lines))
+            self.handle.flush()
+            if self.handle.tell() >= self.max_bytes:
+                self.rotate()
+        except Exception as e:
+            self.logger.error(f"Error writing {len(lines)} lines to the transcript: {e}")
+
+    def rotate(self) -> None:
+        self.handle.close()
+        self.handle = None
+        suffix = ".gz" if self.compress else ""
+        for i in range(self.backups - 1, 0, -1):
+            older = f"{self.filename}.{i}{suffix}"
+            if os.path.exists(older):
+                os.replace(older, f"{self.filename}.{i + 1}{suffix}")
+        if self.backups < 1:
+            os.remove(self.filename)
+        elif self.compress:
+            with open(self.filename, "rb") as src, gzip.open(f"{self.filename}.1.gz", "wb") as dst:
+                shutil.copyfileobj(src, dst)
+            os.remove(self.filename)
+        else:
+            os.replace(self.filename, f"{self.filename}.1")
+        self.logger.info(f"Rotated transcript {self.filename}")
+
+    def close(self) -> None:
+        """Writes whatever is still queued and closes the file (after run() is stopped)."""
+        lines = []
+        while not self.queue.empty():
+            lines.append(self.queue.get_nowait())
+        if lines:
+            self.write_lines(lines)
+        with self.file_lock:
+            if self.handle is not None:
+                self.handle.close()
+                self.handle = None
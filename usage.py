@@ -0,0 +1,195 @@
+# Token and cost accounting for the LLM providers.
+import asyncio
+import csv
+from dataclasses import asdict, dataclass, fields
+import io
+import json
+import logging
+import os
+import time
+
+from file_utils import atomic_write
+
+# USD per million (prompt, completion) tokens.  Model names match on the longest prefix, so
+# "gpt-4o-2024-05-13" is priced as "gpt-4o".  Override or extend with `modelprices=` in keys.txt.
+DEFAULT_PRICES = {
+    "gpt-4o-mini": (0.15, 0.60),
+    "gpt-4o": (5.00, 15.00),
+    "gpt-4-turbo": (10.00, 30.00),
+    "gpt-4": (30.00, 60.00),
+    "gpt-3.5-turbo": (0.50, 1.50),
+    "gemini-1.5-flash": (0.35, 1.05),
+    "gemini-1.5-pro": (3.50, 10.50),
+    "gemini-1.0-pro": (0.50, 1.50),
+}
+# USD per DALL-E 3 image by (quality, size).
+IMAGE_PRICES = {
+    ("standard", "1024x1024"): 0.040,
+    ("standard", "1792x1024"): 0.080,
+    ("standard", "1024x1792"): 0.080,
+    ("hd", "1024x1024"): 0.080,
+    ("hd", "1792x1024"): 0.120,
+    ("hd", "1024x1792"): 0.120,
+}
+
+
+@dataclass(slots=True)
+class UsageTotals:
+    requests: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    cost: float = 0.0
+    latency: float = 0.0  # summed seconds, divide by requests for the average
+    estimated: int = 0  # requests whose token counts were estimated, not reported
+
+    def add(self, other: "UsageTotals") -> None:
+        for f in fields(self):
+            setattr(self, f.name, getattr(self, f.name) + getattr(other, f.name))
+
+
+class UsageTracker:
+    """
+    Aggregates requests, tokens, cost and latency in memory per (user, chat, provider,
+    model).  Per user, per chat and per model totals are rolled up from those when asked
+    for.  A background task writes the totals to a JSON file when they change.
+    """
+
+    def __init__(
+        self, logger: logging.Logger, filename: str = None, prices: dict = None
+    ) -> None:
+        self.logger = logger.getChild("usage")
+        self.filename = filename
+        self.prices = dict(DEFAULT_PRICES)
+        if prices:
+            self.prices.update(prices)
+        # (user id, chat id, provider, model) -> UsageTotals
+        self.totals = {}
+        self.since = time.time()
+        self.dirty = False
+        if self.filename:
+            self.load()
+
+    def price_for(self, model: str) -> tuple[float, float]:
+        best = ""
+        for name in self.prices:
+            if model.startswith(name) and len(name) > len(best):
+                best = name
+        return self.prices[best] if best else (0.0, 0.0)
+
+    def record(
+        self,
+        provider: str,
+        model: str,
+        prompt_tokens: int,
+        completion_tokens: int,
+        latency: float,
+        user_id=None,
+        chat_id=None,
+        estimated: bool = False,
+        cost: float = None,
+    ) -> None:
+        """Adds one request.  `cost` overrides the token based price (used for images)."""
+        if cost is None:
+            prompt_price, completion_price = self.price_for(model)
+            cost = (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1_000_000
+        key = (
+            "" if user_id is None else str(user_id),
+            "" if chat_id is None else str(chat_id),
+            provider,
+            model,
+        )
+        totals = self.totals.get(key)
+        if totals is None:
+            totals = self.totals[key] = UsageTotals()
+        totals.requests += 1
+        totals.prompt_tokens += prompt_tokens
+        totals.completion_tokens += completion_tokens
+        totals.cost += cost
+        totals.latency += latency
+        totals.estimated += int(estimated)
+        self.dirty = True
+
+    def rollup(self, by: str) -> dict[str, UsageTotals]:
+        """Totals grouped by "user", "chat", "model" or "provider"."""
+        position = {"user": 0, "chat": 1, "provider": 2, "model": 3}[by]
+        grouped = {}
+        for key, totals in self.totals.items():
+            group = grouped.setdefault(key[position] or "unknown", UsageTotals())
+            group.add(totals)
+        return grouped
+
+    def overall(self) -> UsageTotals:
+        result = UsageTotals()
+        for totals in self.totals.values():
+            result.add(totals)
+        return result
+
+    def rows(self) -> list[dict]:
+        return [
+            {"user": u, "chat": c, "provider": p, "model": m, **asdict(totals)}
+            for (u, c, p, m), totals in self.totals.items()
+        ]
+
+    def export_json(self) -> str:
+        return json.dumps({"since": self.since, "rows": self.rows()}, indent=1)
+
+    def export_csv(self) -> str:
+        out = io.StringIO()
+        writer = csv.DictWriter(
+            out, fieldnames=["user", "chat", "provider", "model"] + [f.name for f in fields(UsageTotals)]
+        )
+        writer.writeheader()
+        writer.writerows(self.rows())
+        return out.getvalue()
+
+    def reset(self) -> None:
+        self.totals.clear()
+        self.since = time.time()
+        self.dirty = True
+
+    def save(self) -> None:
+        if not self.filename or not self.dirty:
+            return
+        data = self.export_json()
+        self.dirty = False
+        try:
+            atomic_write(self.filename, data)
+        except Exception as e:
+            self.dirty = True
+            self.logger.error(f"Error saving usage totals: {e}")
+
+    async def flush(self) -> None:
+        if not self.filename or not self.dirty:
+            return
+        data = self.export_json()
+        self.dirty = False
+        try:
+            await asyncio.to_thread(atomic_write, self.filename, data)
+        except Exception:
+            self.dirty = True
+            raise
+
+    async def run_saver(self, interval: int):
+        # Background task: write the totals every `interval` seconds if anything changed.
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                self.logger.error(f"Error saving usage totals: {e}")
+
+    def load(self) -> None:
+        if not os.path.exists(self.filename):
+            return
+        try:
+            with open(self.filename, "r") as f:
+                saved = json.load(f)
+            self.since = saved.get("since", self.since)
+            names = {f.name for f in fields(UsageTotals)}
+            for row in saved.get("rows", []):
+                key = (row["user"], row["chat"], row["provider"], row["model"])
+                self.totals[key] = UsageTotals(**{k: v for k, v in row.items() if k in names})
+        except Exception as e:
+            self.logger.error(f"Error loading usage totals: {e}")
+            return
+        self.logger.info(f"Loaded usage totals for {len(self.totals)} user/chat/model entries")
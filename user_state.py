@@ -1,54 +1,188 @@
 # this is used to keep track of what users are doing.
 
+import asyncio
+from collections import OrderedDict
+from dataclasses import dataclass
 from enum import Enum
-import hashlib
+from itertools import islice
 import json
 import logging
+import sys
+import time
 from typing import Optional
 
+from user_store import UserStore
+
+
+class MessageTypes(Enum):
+    COMMAND = "Command"
+    PROMPT = "Prompt"
+    IMAGE = "Image"
+
+
+class LLMTypes(Enum):
+    GPT = "GPT"
+    GEMINI = "Gemini"
+    BOTH = "GPT & Gemini"
+
+
+class DictView:
+    # Lets the handlers keep reading records the old way, e.g. last_prompt["prompt"].
+    __slots__ = ()
+
+    def __getitem__(self, key: str):
+        return getattr(self, key)
+
+    def as_dict(self) -> dict:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+@dataclass(slots=True)
+class PromptState(DictView):
+    prompt: str = ""
+    prompt_to: Optional[LLMTypes] = None
+    prompt_result: str = ""
+
+    def as_dict(self) -> dict:
+        return {
+            "prompt": self.prompt,
+            "prompt_to": self.prompt_to or "",
+            "prompt_result": self.prompt_result,
+        }
+
+
+@dataclass(slots=True)
+class PicState(DictView):
+    prompt: str = ""
+    file_result: str = ""
+
+
+@dataclass(slots=True)
+class CommandState(DictView):
+    command: str = ""
+    command_result: str = ""
+    state_memory: str = ""
+
+
+@dataclass(slots=True)
+class UserRecord(DictView):
+    """
+    Compact state of one user.  The last_* sub-states are only allocated once the user
+    actually prompts, draws or runs a command, so lurkers in listened-to groups stay small.
+    """
+
+    id: str
+    pics: int = 0
+    chatgpt_prompts: int = 0
+    gemini_prompts: int = 0
+    commands: int = 0
+    last_message_type: Optional[MessageTypes] = None
+    awaiting_response: bool = False
+    last_prompt_state: Optional[PromptState] = None
+    last_pic_state: Optional[PicState] = None
+    last_command_state: Optional[CommandState] = None
+    # When the user was last touched, for idle eviction.  Not saved.
+    last_seen: float = 0.0
+
+    def prompt_state(self) -> PromptState:
+        if self.last_prompt_state is None:
+            self.last_prompt_state = PromptState()
+        return self.last_prompt_state
+
+    def pic_state(self) -> PicState:
+        if self.last_pic_state is None:
+            self.last_pic_state = PicState()
+        return self.last_pic_state
+
+    def command_state(self) -> CommandState:
+        if self.last_command_state is None:
+            self.last_command_state = CommandState()
+        return self.last_command_state
+
+    def as_dict(self) -> dict:
+        """The same layout the user state always had, for /getmyuserstate and saving."""
+        return {
+            "id": self.id,
+            "pics": self.pics,
+            "chatgpt_prompts": self.chatgpt_prompts,
+            "gemini_prompts": self.gemini_prompts,
+            "commands": self.commands,
+            "last_message_type": self.last_message_type or "",
+            "last_prompt_state": (self.last_prompt_state or PromptState()).as_dict(),
+            "last_pic_state": (self.last_pic_state or PicState()).as_dict(),
+            "last_command_state": (self.last_command_state or CommandState()).as_dict(),
+            "awaiting_response": self.awaiting_response,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "UserRecord":
+        record = cls(
+            id=sys.intern(str(data.get("id", ""))),
+            pics=data.get("pics", 0),
+            chatgpt_prompts=data.get("chatgpt_prompts", 0),
+            gemini_prompts=data.get("gemini_prompts", 0),
+            commands=data.get("commands", 0),
+            awaiting_response=data.get("awaiting_response", False),
+        )
+        # Enums are saved by value, turn them back into members.
+        if data.get("last_message_type"):
+            record.last_message_type = MessageTypes(data["last_message_type"])
+        prompt = data.get("last_prompt_state") or {}
+        if any(prompt.values()):
+            record.last_prompt_state = PromptState(
+                prompt=prompt.get("prompt", ""),
+                prompt_to=LLMTypes(prompt["prompt_to"]) if prompt.get("prompt_to") else None,
+                prompt_result=prompt.get("prompt_result", ""),
+            )
+        pic = data.get("last_pic_state") or {}
+        if any(pic.values()):
+            record.last_pic_state = PicState(**pic)
+        command = data.get("last_command_state") or {}
+        if any(command.values()):
+            record.last_command_state = CommandState(**command)
+        return record
+
 
 class UserStates:
-    class MessageTypes(Enum):
-        COMMAND = "Command"
-        PROMPT = "Prompt"
-        IMAGE = "Image"
-
-    class LLMTypes(Enum):
-        GPT = "GPT"
-        GEMINI = "Gemini"
-        BOTH = "GPT & Gemini"
-
-    def __init__(self, logger: logging.Logger) -> None:
-        self.users = {}
+    MessageTypes = MessageTypes
+    LLMTypes = LLMTypes
+
+    def __init__(
+        self,
+        logger: logging.Logger,
+        store: Optional[UserStore] = None,
+        idle_ttl: int = 3600,
+        max_resident: int = 5000,
+    ) -> None:
+        # Resident users, least recently used first.
+        self.users = OrderedDict()
         self.logger = logger.getChild("user_state")
+        # Users are loaded from the store the first time they're seen.
+        self.store = store
+        # Users changed since the last save; only these get written.
+        self.dirty = set()
+        # Users taken out of dirty whose write hasn't committed yet.  They stay loaded, or
+        # loading them again from the store would bring back the state before the write.
+        self.in_flight = set()
+        # With a store, users idle for idle_ttl seconds or past max_resident are
+        # dropped from memory and loaded again on their next message.
+        self.idle_ttl = idle_ttl
+        self.max_resident = max_resident
 
     def usercheck(func):
         def usercheck_wrapper(self, username: int | str, *args, **kwargs):
             username = str(username)
-            if not self.user_state_exists(username):
-                self.add_user(username)
+            self.add_user(username)
             return func(self, username, *args, **kwargs)
 
         return usercheck_wrapper
 
     def save_data_change(func):
-        def enum_serailizer(obj):
-            if isinstance(obj, Enum):
-                return obj.value
-            raise TypeError(f"Type {obj.__class__.__name__} not serializable")
-
-        def save_data_change_wrapper(self, *args, **kwargs):
-            hash_before = hashlib.sha256(
-                json.dumps(self.users, sort_keys=True, default=enum_serailizer).encode()
-            ).hexdigest()
-            res = func(self, *args, **kwargs)
-            # detect if we should save
-            after_hash = hashlib.sha256(
-                json.dumps(self.users, sort_keys=True, default=enum_serailizer).encode()
-            ).hexdigest()
-            if hash_before != after_hash:
-                self.logger.info("State of users has changed: Saving")
-                # Save user states.
+        # Marks the user passed to a state-changing method as dirty, so the next save
+        # writes just that record.  Costs the same no matter how many users there are.
+        def save_data_change_wrapper(self, username: int | str, *args, **kwargs):
+            res = func(self, username, *args, **kwargs)
+            self.dirty.add(str(username))
             return res
 
         return save_data_change_wrapper
@@ -57,16 +191,58 @@ class UserStates:
         username = str(username)
         if username in self.users.keys():
             return True
+        if self.store is not None:
+            return self.store.exists(username)
         return False
 
     def remove_user_state(self, username: int | str) -> None:
+        username = str(username)
         self.users.pop(username, "")
+        self.dirty.discard(username)
+        if self.store is not None:
+            self.store.delete(username)
 
     def add_user(self, username: int | str) -> None:
         username = str(username)
-        if not self.user_state_exists(username):
-            self.users[username] = self.create_user_state(username)
+        record = self.users.get(username)
+        if record is None:
+            record = self.load_user(username)
+            if record is None:
+                record = self.create_user_state(username)
+            record.last_seen = time.time()
+            self.users[username] = record
+            if len(self.users) > self.max_resident:
+                self.evict()
+        else:
+            self.users.move_to_end(username)
+            record.last_seen = time.time()
 
+    def evict(self) -> int:
+        """
+        Drops saved users from memory, oldest first: everyone idle past idle_ttl, then more
+        until we're back under max_resident.  Unsaved users, dirty or still being written,
+        are kept until their write commits.  Returns how many users were dropped.
+        """
+        if self.store is None:
+            return 0
+        idle_before = time.time() - self.idle_ttl
+        evicted = []
+        over = len(self.users) - self.max_resident
+        # Never the most recent user, that one is about to be used.
+        for username, record in islice(self.users.items(), len(self.users) - 1):
+            if record.last_seen >= idle_before and over <= 0:
+                break
+            if username in self.dirty or username in self.in_flight:
+                continue
+            evicted.append(username)
+            over -= 1
+        for username in evicted:
+            del self.users[username]
+        if evicted:
+            self.logger.info(f"Evicted {len(evicted)} idle users, {len(self.users)} still loaded")
+        return len(evicted)
+
+    @save_data_change
     @usercheck
     def update_prompt(
         self,
@@ -76,27 +252,24 @@ class UserStates:
         prompt_result: Optional[str] = None,
         do_not_increase=False,
     ):
-        self.users[username]["last_message_type"] = self.MessageTypes.PROMPT
+        record = self.users[username]
+        record.last_message_type = MessageTypes.PROMPT
         if not do_not_increase:
-            if prompt_to == self.LLMTypes.GPT:
-                self.users[username]["chatgpt_prompts"] += 1
-            elif prompt_to == self.LLMTypes.GEMINI:
-                self.users[username]["gemini_prompts"] += 1
-            elif prompt_to == self.LLMTypes.BOTH:
-                self.users[username]["chatgpt_prompts"] += 1
-                self.users[username]["gemini_prompts"] += 1
-        self.users[username]["last_prompt_state"]["prompt"] = (
-            self.users[username]["last_prompt_state"]["prompt"]
-            if prompt is None
-            else prompt
-        )
-        self.users[username]["last_prompt_state"]["prompt_to"] = prompt_to
-        self.users[username]["last_prompt_state"]["prompt_result"] = (
-            self.users[username]["last_prompt_state"]["prompt_result"]
-            if prompt_result is None
-            else prompt_result
-        )
+            if prompt_to == LLMTypes.GPT:
+                record.chatgpt_prompts += 1
+            elif prompt_to == LLMTypes.GEMINI:
+                record.gemini_prompts += 1
+            elif prompt_to == LLMTypes.BOTH:
+                record.chatgpt_prompts += 1
+                record.gemini_prompts += 1
+        state = record.prompt_state()
+        if prompt is not None:
+            state.prompt = prompt
+        state.prompt_to = prompt_to
+        if prompt_result is not None:
+            state.prompt_result = prompt_result
 
+    @save_data_change
     @usercheck
     def update_pic(
         self,
@@ -105,18 +278,14 @@ class UserStates:
         prompt_result: Optional[str] = None,
     ):
         # anything that is not None should be updated.
-        self.users[username]["pics"] += 1
-        self.users[username]["last_message_type"] = self.MessageTypes.IMAGE
-        self.users[username]["last_pic_state"]["prompt"] = (
-            self.users[username]["last_pic_state"]["prompt"]
-            if prompt is None
-            else prompt
-        )
-        self.users[username]["last_pic_state"]["file_result"] = (
-            self.users[username]["last_pic_state"]["file_result"]
-            if prompt_result is None
-            else prompt_result
-        )
+        record = self.users[username]
+        record.pics += 1
+        record.last_message_type = MessageTypes.IMAGE
+        state = record.pic_state()
+        if prompt is not None:
+            state.prompt = prompt
+        if prompt_result is not None:
+            state.file_result = prompt_result
 
     @save_data_change
     @usercheck
@@ -127,19 +296,16 @@ class UserStates:
         prompt_result: Optional[str] = None,
     ):
         # anything that is not None should be updated.  Note that prompt = command, ect...
-        self.users[username]["last_command_state"]["command"] = (
-            self.users[username]["last_command_state"]["command"]
-            if prompt is None
-            else prompt
-        )
-        self.users[username]["last_command_state"]["command_result"] = (
-            self.users[username]["last_command_state"]["command_result"]
-            if prompt_result is None
-            else prompt_result
-        )
-        self.users[username]["commands"] += 1
-        self.users[username]["last_message_type"] = self.MessageTypes.COMMAND
+        record = self.users[username]
+        state = record.command_state()
+        if prompt is not None:
+            state.command = prompt
+        if prompt_result is not None:
+            state.command_result = prompt_result
+        record.commands += 1
+        record.last_message_type = MessageTypes.COMMAND
 
+    @save_data_change
     @usercheck
     def update_user_response_required(
         self,
@@ -148,95 +314,151 @@ class UserStates:
         state_memory: Optional[str] = None,
         command: Optional[str] = None,
     ) -> None:
-        self.users[username]["awaiting_response"] = response_required
-        self.users[username]["last_command_state"]["state_memory"] = (
-            self.users[username]["last_command_state"]["state_memory"]
-            if state_memory is None
-            else state_memory
-        )
-        self.users[username]["last_command_state"]["command"] = (
-            self.users[username]["last_command_state"]["command"]
-            if command is None
-            else command
-        )
-        self.users[username]["last_message_type"] = self.MessageTypes.COMMAND
-        self.users[username]["commands"] += 1
+        record = self.users[username]
+        record.awaiting_response = response_required
+        state = record.command_state()
+        if state_memory is not None:
+            state.state_memory = state_memory
+        if command is not None:
+            state.command = command
+        record.last_message_type = MessageTypes.COMMAND
+        record.commands += 1
 
+    @save_data_change
     @usercheck
     def clear_user_response_required(self, username: int | str) -> None:
-        self.users[username]["awaiting_response"] = False
-        self.users[username]["last_command_state"]["state_memory"] = ""
-        self.users[username]["last_command_state"]["command"] = ""
-
-    def create_user_state(self, username: str) -> dict:
-        out_dict = {
-            "id": username,
-            "pics": 0,
-            "chatgpt_prompts": 0,
-            "gemini_prompts": 0,
-            "commands": 0,
-            "last_message_type": "",
-            "last_prompt_state": {
-                "prompt": "",
-                "prompt_to": "",
-                "prompt_result": "",
-            },
-            "last_pic_state": {
-                "prompt": "",
-                "file_result": "",
-            },
-            "last_command_state": {
-                "command": "",
-                "command_result": "",
-                "state_memory": "",
-            },
-            "awaiting_response": False,
-        }
-        return out_dict
+        record = self.users[username]
+        record.awaiting_response = False
+        if record.last_command_state is not None:
+            record.last_command_state.state_memory = ""
+            record.last_command_state.command = ""
+
+    def create_user_state(self, username: str) -> UserRecord:
+        return UserRecord(id=sys.intern(username))
 
     @usercheck
     def how_many_pics(self, username: str) -> int:
-        return self.users[username]["pics"]
+        return self.users[username].pics
 
     @usercheck
     def how_many_chatgpt_prompts(self, username: str) -> int:
-        return self.users[username]["chatgpt_prompts"]
+        return self.users[username].chatgpt_prompts
 
     @usercheck
     def how_many_gemini_prompts(self, username: str) -> int:
-        return self.users[username]["gemini_prompts"]
+        return self.users[username].gemini_prompts
 
     @usercheck
     def how_many_commands(self, username: str) -> int:
-        return self.users[username]["commands"]
+        return self.users[username].commands
 
     @usercheck
-    def get_last_prompt(self, username: str) -> dict:
-        return self.users[username]["last_prompt_state"]
+    def get_last_prompt(self, username: str) -> PromptState:
+        return self.users[username].last_prompt_state or PromptState()
 
     @usercheck
-    def get_last_pic(self, username: str) -> dict:
-        return self.users[username]["last_pic_state"]
+    def get_last_pic(self, username: str) -> PicState:
+        return self.users[username].last_pic_state or PicState()
 
     @usercheck
-    def get_last_command(self, username: str) -> dict:
-        return self.users[username]["last_command_state"]
+    def get_last_command(self, username: str) -> CommandState:
+        return self.users[username].last_command_state or CommandState()
 
     @usercheck
     def get_user_state(self, username: str) -> dict:
-        return self.users[username]
+        return self.users[username].as_dict()
 
     @usercheck
     def get_user_last_action(self, username: str) -> str:
-        return self.users[username]["last_message_type"]
+        return self.users[username].last_message_type or ""
 
     def total_users(self) -> int:
         return len(self.users)
 
+    def stored_users(self) -> int:
+        return self.store.count() if self.store is not None else 0
+
+    @staticmethod
+    def state_to_json(record: UserRecord) -> str:
+        def enum_serializer(obj):
+            if isinstance(obj, Enum):
+                return obj.value
+            raise TypeError(f"Type {obj.__class__.__name__} not serializable")
+
+        return json.dumps(record.as_dict(), default=enum_serializer)
+
+    def state_from_json(self, raw: str) -> UserRecord:
+        return UserRecord.from_dict(json.loads(raw))
+
+    def load_user(self, username: str) -> Optional[UserRecord]:
+        if self.store is None:
+            return None
+        try:
+            raw = self.store.load(username)
+            return self.state_from_json(raw) if raw else None
+        except Exception as e:
+            self.logger.error(f"Error loading user {username}, starting fresh: {e}")
+            return None
+
+    def take_dirty(self) -> list[tuple[str, str]]:
+        """
+        Serializes the changed users and moves them from dirty to in_flight; call
+        written() once the store has (or hasn't) committed them.
+        """
+        dirty, self.dirty = self.dirty, set()
+        self.in_flight.update(dirty)
+        return [
+            (username, self.state_to_json(self.users[username]))
+            for username in dirty
+            if username in self.users
+        ]
+
+    def written(self, records: list[tuple[str, str]], saved: bool) -> None:
+        """Ends a write started by take_dirty(); unsaved users are marked dirty again."""
+        usernames = {username for username, _ in records}
+        self.in_flight -= usernames
+        if not saved:
+            # Try again next time; newer changes may have re-marked some of these already.
+            self.dirty.update(username for username in usernames if username in self.users)
+
     def save_users(self):
-        # TODO : This should save to file or db.
-        pass
+        """Writes the changed users to the store in one transaction (blocking)."""
+        if self.store is None:
+            return
+        records = self.take_dirty()
+        saved = False
+        try:
+            self.store.save_many(records)
+            saved = True
+        finally:
+            self.written(records, saved)
+        if records:
+            self.logger.info(f"Saved {len(records)} user states")
+
+    async def flush(self):
+        """Same as save_users(), but the database write happens off the event loop."""
+        if self.store is None or not self.dirty:
+            return
+        records = self.take_dirty()
+        saved = False
+        try:
+            await asyncio.to_thread(self.store.save_many, records)
+            saved = True
+        finally:
+            self.written(records, saved)
+
+    async def run_saver(self, interval: int):
+        # Background task: batch all changes into one write every `interval` seconds,
+        # then trim the users held in memory.
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.flush()
+                self.evict()
+            except Exception as e:
+                self.logger.error(f"Error saving user states: {e}")
 
     def load_users(self):
-        # TODO : This should load from file or db.
-        pass
+        # Users are loaded lazily on first access (see usercheck), so only report here.
+        if self.store is not None:
+            self.logger.info(f"{self.store.count()} saved users will be loaded on demand")
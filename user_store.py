@@ -0,0 +1,124 @@
+# SQLite storage for user states and conversation history.
+import logging
+import sqlite3
+import threading
+import time
+
+
+class UserStore:
+    """
+    Keeps one JSON document per user, and the recent exchanges of each conversation, in a
+    SQLite database running in WAL mode, so writes from the saver thread never block
+    readers.  All methods are thread safe.
+    """
+
+    def __init__(self, filename: str, logger: logging.Logger) -> None:
+        self.filename = filename
+        self.logger = logger.getChild("user_store")
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(filename, check_same_thread=False)
+        with self.lock:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS users ("
+                " id TEXT PRIMARY KEY,"
+                " state TEXT NOT NULL,"
+                " updated REAL NOT NULL)"
+            )
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS exchanges ("
+                " seq INTEGER PRIMARY KEY AUTOINCREMENT,"
+                " chat_id TEXT NOT NULL,"
+                " user_id TEXT NOT NULL,"
+                " prompt TEXT NOT NULL,"
+                " answer TEXT NOT NULL,"
+                " created REAL NOT NULL)"
+            )
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS exchanges_by_conversation"
+                " ON exchanges (chat_id, user_id, seq)"
+            )
+            self.conn.commit()
+        self.logger.info(f"User store '{filename}' opened with {self.count()} users.")
+
+    def load(self, user_id: str) -> str | None:
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT state FROM users WHERE id = ?", (user_id,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def exists(self, user_id: str) -> bool:
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT 1 FROM users WHERE id = ?", (user_id,)
+            ).fetchone()
+        return row is not None
+
+    def save_many(self, records: list[tuple[str, str]]) -> None:
+        """Writes [(user id, JSON state), ...] in a single transaction."""
+        if not records:
+            return
+        now = time.time()
+        with self.lock:
+            with self.conn:
+                self.conn.executemany(
+                    "INSERT INTO users (id, state, updated) VALUES (?, ?, ?)"
+                    " ON CONFLICT(id) DO UPDATE SET state = excluded.state, updated = excluded.updated",
+                    [(user_id, state, now) for user_id, state in records],
+                )
+
+    def delete(self, user_id: str) -> None:
+        with self.lock:
+            with self.conn:
+                self.conn.execute("DELETE FROM users WHERE id = ?", (user_id,))
+
+    def load_exchanges(self, chat_id: str, user_id: str, limit: int) -> list[tuple[str, str]]:
+        """The last `limit` (prompt, answer) pairs of a conversation, oldest first."""
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT prompt, answer FROM exchanges WHERE chat_id = ? AND user_id = ?"
+                " ORDER BY seq DESC LIMIT ?",
+                (chat_id, user_id, limit),
+            ).fetchall()
+        return rows[::-1]
+
+    def save_exchanges(self, changes: list[tuple], keep: int) -> None:
+        """
+        Applies [(chat id, user id, prompt, answer), ...] in order in a single transaction;
+        a change with prompt None clears that conversation.  Only the last `keep`
+        exchanges of each conversation are kept.
+        """
+        if not changes:
+            return
+        now = time.time()
+        with self.lock:
+            with self.conn:
+                for chat_id, user_id, prompt, answer in changes:
+                    if prompt is None:
+                        self.conn.execute(
+                            "DELETE FROM exchanges WHERE chat_id = ? AND user_id = ?",
+                            (chat_id, user_id),
+                        )
+                    else:
+                        self.conn.execute(
+                            "INSERT INTO exchanges (chat_id, user_id, prompt, answer, created)"
+                            " VALUES (?, ?, ?, ?, ?)",
+                            (chat_id, user_id, prompt, answer, now),
+                        )
+                for chat_id, user_id in {change[:2] for change in changes}:
+                    self.conn.execute(
+                        "DELETE FROM exchanges WHERE chat_id = ? AND user_id = ? AND seq NOT IN"
+                        " (SELECT seq FROM exchanges WHERE chat_id = ? AND user_id = ?"
+                        " ORDER BY seq DESC LIMIT ?)",
+                        (chat_id, user_id, chat_id, user_id, keep),
+                    )
+
+    def count(self) -> int:
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+
+    def close(self) -> None:
+        with self.lock:
+            self.conn.close()